@@ -73,17 +73,17 @@ setup(
     keywords='',
     license='MIT',
     install_requires=get_install_requirements('requirements.txt'),
+    python_requires='>=3.6',
     tests_require=['pytest-cov', 'pytest'],
     cmdclass={'test': PyTest},
     test_suite='tests',
     classifiers=[
         'Programming Language :: Python',
-        'Programming Language :: Python :: 3.4',
-        'Programming Language :: Python :: 3.5',
+        'Programming Language :: Python :: 3.6',
         'Development Status :: 5 - Production/Stable',
         'Intended Audience :: Developers',
         'Operating System :: OS Independent',
     ],
     include_package_data=True,  # required to include YAML templates
-    entry_points={'console_scripts': ['zdeploy = zalando_deploy_cli.cli:main']}
+    entry_points={'console_scripts': ['zdeploy = zalando_deploy_cli.completion:main']}
 )
@@ -0,0 +1,95 @@
+import os
+import threading
+import time
+
+import yaml
+from zalando_deploy_cli import agent
+from zalando_deploy_cli.cli import cli, is_forwardable, kubectl_login
+
+
+def test_forward_without_agent(tmp_path):
+    assert agent.forward(str(tmp_path / 'agent.sock'), ['list-change-requests']) is None
+
+
+def test_forward_to_agent(tmp_path, monkeypatch):
+    monkeypatch.setattr('stups_cli.config.load_config', lambda section: {})
+    socket_path = str(tmp_path / 'agent.sock')
+    template = tmp_path / 'template.yaml'
+    template.write_text('foo: "{{bar}}"\n')
+
+    server = agent.AgentServer(socket_path, lambda args: cli.main(args=args, prog_name='zdeploy'))
+    thread = threading.Thread(target=server.handle_request)
+    thread.start()
+    try:
+        monkeypatch.chdir(tmp_path)
+        response = agent.forward(socket_path, ['render-template', 'template.yaml', 'bar=baz'])
+    finally:
+        thread.join()
+        server.server_close()
+
+    assert 0 == response['exit_code']
+    assert {'foo': 'baz'} == yaml.safe_load(response['stdout'])
+
+
+def test_is_forwardable():
+    assert is_forwardable(['list-change-requests'])
+    assert is_forwardable(['-o', 'json', 'get-change-request', 'abc'])
+    assert not is_forwardable(['-o', 'json', 'encrypt'])
+    assert not is_forwardable(['--output=json', 'init', 'myapp'])
+    assert not is_forwardable(['wait-for-deployment', 'myapp', 'v1', 'r1'])
+    assert not is_forwardable(['apply', 'templates/', '--watch'])
+    assert not is_forwardable(['-o', 'json'])
+
+
+def test_forward_to_busy_agent(tmp_path):
+    socket_path = str(tmp_path / 'agent.sock')
+    started = threading.Event()
+    finish = threading.Event()
+
+    def handler(args):
+        started.set()
+        finish.wait(5)
+
+    server = agent.AgentServer(socket_path, handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    try:
+        first = threading.Thread(target=agent.forward, args=(socket_path, ['apply']))
+        first.start()
+        assert started.wait(5)
+        # agent is busy: client has to run the command itself
+        assert agent.forward(socket_path, ['apply']) is None
+        finish.set()
+        first.join()
+    finally:
+        server.shutdown()
+        thread.join()
+        server.server_close()
+
+
+def test_kubectl_login_cache(monkeypatch, tmp_path):
+    kubeconfig = tmp_path / 'kubeconfig'
+    monkeypatch.setenv('KUBECONFIG', str(kubeconfig))
+    monkeypatch.setattr('zalando_deploy_cli.cli._kubectl_login', (None, 0))
+
+    def login(cmd):
+        # zkubectl switches the context of the shared kubeconfig
+        kubeconfig.write_text('current-context: {}\n'.format(cmd[-1]))
+        mtime = int(time.time() + len(calls)) * 10 ** 9
+        os.utime(str(kubeconfig), ns=(mtime, mtime))
+        calls.append(cmd[-1])
+    calls = []
+    monkeypatch.setattr('subprocess.check_call', login)
+
+    kubectl_login({'kubernetes_cluster': 'a'})
+    kubectl_login({'kubernetes_cluster': 'a'})
+    assert calls == ['a']
+    kubectl_login({'kubernetes_cluster': 'b'})
+    # kubeconfig points to cluster b now
+    kubectl_login({'kubernetes_cluster': 'a'})
+    assert calls == ['a', 'b', 'a']
+
+    # login of another process (e.g. while the agent was busy)
+    login(['zkubectl', 'login', 'b'])
+    kubectl_login({'kubernetes_cluster': 'a'})
+    assert calls == ['a', 'b', 'a', 'b', 'a']
@@ -1,7 +1,9 @@
 import json
+import time
 import pytest
 import requests
 import yaml
+from pathlib import Path
 import zalando_deploy_cli.cli
 from unittest.mock import MagicMock, ANY
 
@@ -217,9 +219,7 @@ def test_encrypt(monkeypatch, mock_config):
     result = runner.invoke(cli, ['encrypt'], input='my_secret')
     assert 'deployment-secret:barFooBAR=' == result.output.strip()
 
-    encrypt_call.assert_called_with(mock_config(), requests.post,
-                                    mock_config().get('deploy_api') + '/secrets',
-                                    json={'plaintext': 'my_secret'})
+    encrypt_call.assert_called_with(mock_config(), requests.post, '/secrets', json={'plaintext': 'my_secret'})
 
 
 def test_resolve_version(monkeypatch):
@@ -232,3 +232,495 @@ def test_resolve_version(monkeypatch):
         result = runner.invoke(cli, ['resolve-version', 'template.yaml', 'my-app', 'latest', 'r1', 'replicas=3'], catch_exceptions=False)
         print(result)
     assert 'cd123' == result.output.strip()
+
+
+def test_kubectl_get_columns(monkeypatch):
+    popen = MagicMock()
+    proc = popen.return_value.__enter__.return_value
+    proc.stdout = [b'Running   true,true\n', b'Pending   <none>\n', b'\n']
+    proc.returncode = 0
+    monkeypatch.setattr('subprocess.Popen', popen)
+
+    rows = list(zalando_deploy_cli.cli.kubectl_get_columns('myns', zalando_deploy_cli.cli.POD_READINESS_COLUMNS,
+                                                           'pods', '-l', 'application=myapp'))
+    assert [('Running', 'true,true'), ('Pending', '<none>')] == rows
+    popen.assert_called_once_with(['zkubectl', 'get', '--namespace=myns', '--no-headers', '-o',
+                                   'custom-columns=PHASE:.status.phase,READY:.status.containerStatuses[*].ready',
+                                   'pods', '-l', 'application=myapp'], stdout=ANY)
+
+
+def test_wait_for_deployment(monkeypatch, mock_config):
+    kubectl_get_columns = MagicMock()
+    kubectl_get_columns.side_effect = [
+        iter([('Running', 'true,false'), ('Pending', '<none>')]),
+        iter([('Running', 'true,true'), ('Running', 'true')]),
+    ]
+    monkeypatch.setattr('zalando_deploy_cli.cli.kubectl_login', MagicMock())
+    monkeypatch.setattr('zalando_deploy_cli.cli.kubectl_get_columns', kubectl_get_columns)
+    monkeypatch.setattr('time.sleep', MagicMock())
+
+    runner = CliRunner()
+    result = runner.invoke(cli, ['wait-for-deployment', 'myapp', 'v1', 'r1'])
+    assert result.exit_code == 0
+    assert 'myapp-v1-r1 (0/2 pods ready)' in result.output
+    assert kubectl_get_columns.call_count == 2
+
+
+def test_encrypt_batch(monkeypatch, mock_config):
+    def encrypt_call(config, method, url, json):
+        response = MagicMock()
+        response.json.return_value = {'data': json['plaintext'][::-1]}
+        return response
+    monkeypatch.setattr('zalando_deploy_cli.cli.request', encrypt_call)
+
+    runner = CliRunner()
+    stdin = '# comment\nDB_PASSWORD=abc=1\n\n{"name": "API_KEY", "value": "xyz"}\n{"TOKEN": "t0k"}\n'
+    result = runner.invoke(cli, ['encrypt', '--batch'], input=stdin)
+    assert [{'name': 'DB_PASSWORD', 'value': 'deployment-secret:1=cba'},
+            {'name': 'API_KEY', 'value': 'deployment-secret:zyx'},
+            {'name': 'TOKEN', 'value': 'deployment-secret:k0t'}] == yaml.safe_load(result.output)
+
+
+def test_wait_for_change_request(monkeypatch, mock_config):
+    responses = {
+        'cr-1': [{'id': 'cr-1', 'executed': False}, {'id': 'cr-1', 'executed': True}],
+        'cr-2': [{'id': 'cr-2', 'executed': True}],
+    }
+
+    def get_change_request(config, method, path):
+        response = MagicMock()
+        response.json.return_value = responses[path.split('/')[-1]].pop(0)
+        return response
+
+    monkeypatch.setattr('zalando_deploy_cli.cli.request', get_change_request)
+    monkeypatch.setattr('time.sleep', MagicMock())
+
+    runner = CliRunner()
+    result = runner.invoke(cli, ['wait-for-change-request', 'cr-1', 'cr-2'])
+    assert result.exit_code == 0
+    assert 'Change request cr-2 executed.' in result.output
+    assert 'Change request cr-1 executed.' in result.output
+
+
+def test_wait_for_change_request_failed(monkeypatch, mock_config):
+    request = MagicMock()
+    request.return_value.json.return_value = {'id': 'cr-1', 'status': 'FAILED'}
+    monkeypatch.setattr('zalando_deploy_cli.cli.request', request)
+
+    runner = CliRunner()
+    result = runner.invoke(cli, ['wait-for-change-request', 'cr-1'])
+    assert result.exit_code == 1
+    assert 'Change request cr-1 failed.' in result.output
+
+
+def test_list_change_requests_output_formats(monkeypatch, mock_config):
+    body = {'items': [{'id': 'cr-1', 'platform': 'kubernetes', 'kind': 'create', 'user': 'jdoe', 'executed': True}]}
+    request = MagicMock()
+    request.return_value.json.return_value = body
+    request.return_value.iter_content.return_value = [b'{"items": [{"id": "cr-1", ', b'"user": "jdo\xc3', b'\xa9"}]}']
+    monkeypatch.setattr('zalando_deploy_cli.cli.request', request)
+
+    runner = CliRunner()
+    result = runner.invoke(cli, ['-o', 'json', 'list-change-requests'])
+    assert {'items': [{'id': 'cr-1', 'user': 'jdoé'}]} == json.loads(result.output)
+
+    result = runner.invoke(cli, ['--output', 'ndjson', 'list-change-requests'])
+    assert body['items'] == [json.loads(line) for line in result.output.splitlines()]
+
+
+def test_get_change_request_json(monkeypatch, mock_config):
+    request = MagicMock()
+    request.return_value.iter_content.side_effect = lambda chunk_size: [b'{"id": "cr"}']
+    monkeypatch.setattr('zalando_deploy_cli.cli.request', request)
+
+    runner = CliRunner()
+    result = runner.invoke(cli, ['-o', 'json', 'get-change-request', 'cr', 'cr'])
+    assert [{'id': 'cr'}, {'id': 'cr'}] == json.loads(result.output)
+
+
+def test_create_deployment_targets(monkeypatch, mock_config):
+    submitted = {}
+
+    def post(config, method, path, exit_on_error, json):
+        submitted[path] = json
+        response = MagicMock()
+        response.status_code = 201 if 'cluster-a' in path else 403
+        response.json.return_value = {'id': 'cr-a'}
+        return response
+
+    monkeypatch.setattr('zalando_deploy_cli.cli.request', post)
+
+    runner = CliRunner()
+    with runner.isolated_filesystem():
+        with open('template.yaml', 'w') as fd:
+            fd.write('metadata: {namespace: "{{kubernetes_namespace}}", name: "{{application}}"}\n')
+        with open('targets.txt', 'w') as fd:
+            fd.write('# more targets\naws:123:eu-central-1:cluster-b:ns-b\n')
+
+        result = runner.invoke(cli, ['create-deployment', 'template.yaml', 'my-app', 'v1', 'r1',
+                                     '--target=aws:123:eu-central-1:cluster-a:ns-a', '--targets-file=targets.txt'])
+        ndjson_result = runner.invoke(cli, ['-o', 'ndjson', 'create-deployment', 'template.yaml', 'my-app', 'v1',
+                                            'r1', '--targets-file=targets.txt'])
+    assert [row['status'] for row in map(json.loads, ndjson_result.stdout.splitlines())] == ['HTTP error 403']
+    assert {'metadata': {'namespace': 'ns-a', 'name': 'my-app'}} == submitted[
+        '/kubernetes-clusters/aws:123:eu-central-1:cluster-a/namespaces/ns-a/resources']
+    assert {'metadata': {'namespace': 'ns-b', 'name': 'my-app'}} == submitted[
+        '/kubernetes-clusters/aws:123:eu-central-1:cluster-b/namespaces/ns-b/resources']
+    assert 'cr-a' in result.output
+    assert 'HTTP error 403' in result.output
+    assert result.exit_code == 1
+
+
+def test_apply_skip_unchanged(monkeypatch, mock_config):
+    request = MagicMock()
+    request.return_value.json.return_value = {'id': 'my-cr-id'}
+    kubectl_get = MagicMock(side_effect=zalando_deploy_cli.cli.subprocess.CalledProcessError(1, 'zkubectl'))
+    monkeypatch.setattr('zalando_deploy_cli.cli.request', request)
+    monkeypatch.setattr('zalando_deploy_cli.cli.approve_and_execute', MagicMock())
+    monkeypatch.setattr('zalando_deploy_cli.cli.kubectl_login', MagicMock())
+    monkeypatch.setattr('zalando_deploy_cli.cli.kubectl_get', kubectl_get)
+
+    runner = CliRunner()
+    with runner.isolated_filesystem():
+        with open('service.yaml', 'w') as fd:
+            yaml.dump({'kind': 'Service', 'metadata': {'name': '{{application}}'}}, fd)
+        args = ['apply', 'service.yaml', 'application=myapp', '--execute', '--skip-unchanged',
+                '--state-file=state.json']
+
+        result = runner.invoke(cli, args)
+        assert 'Applying Kubernetes manifest service.yaml..' in result.output
+        annotations = request.call_args[1]['json']['metadata']['annotations']
+        assert zalando_deploy_cli.cli.LAST_APPLIED_HASH_ANNOTATION in annotations
+
+        result = runner.invoke(cli, args)
+        assert 'Skipping unchanged Kubernetes manifest service.yaml..' in result.output
+        assert request.call_count == 1
+
+        result = runner.invoke(cli, args[:2] + ['application=otherapp'] + args[3:])
+        assert 'Applying Kubernetes manifest service.yaml..' in result.output
+        assert request.call_count == 2
+
+
+def test_watch_templates(monkeypatch, tmp_path):
+    monkeypatch.setattr('time.sleep', MagicMock())
+    mtimes = iter([
+        {'a.yaml': 1, 'b.yaml': 1},
+        {'a.yaml': 2, 'b.yaml': 1},  # change detected..
+        {'a.yaml': 3, 'b.yaml': 1, 'c.yaml': 1},  # ..but still saving
+        {'a.yaml': 3, 'b.yaml': 1, 'c.yaml': 1},  # settled
+    ])
+    monkeypatch.setattr('zalando_deploy_cli.cli.get_modification_times', lambda path: next(mtimes))
+
+    callback = MagicMock(side_effect=KeyboardInterrupt)
+    with pytest.raises(KeyboardInterrupt):
+        zalando_deploy_cli.cli.watch_templates(str(tmp_path), callback)
+    callback.assert_called_once_with(['a.yaml', 'c.yaml'])
+
+
+def test_bundle_and_apply_bundle(monkeypatch, mock_config):
+    monkeypatch.setattr('zign.api.get_token', lambda a, b: 'mytok')
+    monkeypatch.setattr('pierone.api.get_latest_tag', lambda a, b: 'cd123')
+    request = MagicMock()
+    request.return_value.json.return_value = {'id': 'my-cr-id'}
+    monkeypatch.setattr('zalando_deploy_cli.cli.request', request)
+
+    runner = CliRunner()
+    with runner.isolated_filesystem():
+        Path('deploy/apply').mkdir(parents=True)
+        with open('deploy/apply/service.yaml', 'w') as fd:
+            yaml.dump({'kind': 'Service', 'metadata': {'name': '{{application}}'}}, fd)
+        with open('deploy/deployment.yaml', 'w') as fd:
+            yaml.dump({'kind': 'Deployment', 'metadata': {'name': '{{application}}-{{version}}-{{release}}'},
+                       'spec': {'template': {'spec': {'containers': [
+                           {'image': 'myregistry.example.org/foo/bar:{{version}}'}]}}}}, fd)
+
+        result = runner.invoke(cli, ['bundle', 'deploy', 'my-app', 'latest', 'r1'])
+        assert 'cd123' == result.output.splitlines()[-1]
+
+        result = runner.invoke(cli, ['apply-bundle', 'bundle.json', '--stage=deployment'])
+        assert 'my-cr-id' == result.output.splitlines()[-1]
+        assert 1 == request.call_count
+        assert 'my-app-cd123-r1' == request.call_args[1]['json']['metadata']['name']
+
+        with open('bundle.json') as fd:
+            bundle = json.load(fd)
+        bundle['version'] = 'other'
+        with open('bundle.json', 'w') as fd:
+            json.dump(bundle, fd)
+        result = runner.invoke(cli, ['apply-bundle', 'bundle.json'])
+        assert 'Checksum mismatch for bundle bundle.json' in result.output
+        assert 1 == request.call_count
+
+
+def test_plan_switch():
+    deployments = [
+        {'metadata': {'name': 'myapp-v1-r1'}, 'spec': {'replicas': 2}},
+        {'metadata': {'name': 'myapp-v2-r2'}, 'spec': {'replicas': 6}},
+        {'metadata': {'name': 'myapp-v3-r3'}, 'spec': {'replicas': 0}},
+    ]
+    assert [('myapp-v3-r3', 3), ('myapp-v2-r2', 5), ('myapp-v1-r1', 2)] == \
+        zalando_deploy_cli.cli.plan_switch(deployments, 'myapp-v3-r3', 3, 10)
+    assert [('myapp-v3-r3', 10), ('myapp-v2-r2', 0), ('myapp-v1-r1', 0)] == \
+        zalando_deploy_cli.cli.plan_switch(deployments, 'myapp-v3-r3', 10, 10)
+
+
+def test_switch_deployment_scale_down_after_ready(monkeypatch, mock_config):
+    kubectl_get = MagicMock(return_value={'items': [
+        {'metadata': {'name': 'myapp-v1-r1'}, 'spec': {'replicas': 4}},
+        {'metadata': {'name': 'myapp-v2-r2'}, 'spec': {'replicas': 0}},
+    ]})
+    request = MagicMock()
+    request.return_value.json.return_value = {'id': 'my-change-request-id'}
+    approve_and_execute = MagicMock()
+    wait_for_pods_ready = MagicMock(return_value=True)
+    monkeypatch.setattr('zalando_deploy_cli.cli.kubectl_login', MagicMock())
+    monkeypatch.setattr('zalando_deploy_cli.cli.kubectl_get', kubectl_get)
+    monkeypatch.setattr('zalando_deploy_cli.cli.kubectl_get_columns', lambda *args: iter([('Running', 'true')] * 6))
+    monkeypatch.setattr('zalando_deploy_cli.cli.request', request)
+    monkeypatch.setattr('zalando_deploy_cli.cli.approve_and_execute', approve_and_execute)
+    monkeypatch.setattr('zalando_deploy_cli.cli.wait_for_pods_ready', wait_for_pods_ready)
+
+    runner = CliRunner()
+    result = runner.invoke(cli, ['switch-deployment', 'myapp', 'v2', 'r2', '2/4', '--execute',
+                                 '--scale-down-after-ready', '--min-ready-capacity=4'])
+    assert ('Scaling up deployment myapp-v2-r2 to 2 replicas..\n'
+            'Scaling down deployment myapp-v1-r1 to 2 replicas..' == result.output.strip())
+    assert [{'name': 'myapp-v2-r2', 'kind': 'deployments',
+             'operations': [{'op': 'replace', 'path': '/spec/replicas', 'value': 2}]}] == \
+        request.call_args_list[0][1]['json']['resources_update']
+    wait_for_pods_ready.assert_called_once_with('mynamespace', 'myapp', 'v2', 'r2', 300, interval=10, min_ready=2)
+    assert 2 == approve_and_execute.call_count
+
+    result = runner.invoke(cli, ['switch-deployment', 'myapp', 'v2', 'r2', '2/4', '--execute',
+                                 '--scale-down-after-ready', '--min-ready-capacity=5'])
+    assert 'Only 4 of minimum 5 pods would remain ready, not scaling down.' in result.output
+    assert result.exit_code == 1
+
+    result = runner.invoke(cli, ['switch-deployment', 'myapp', 'v2', 'r2', '2/4', '--execute',
+                                 '--min-ready-capacity=5'])
+    assert '--min-ready-capacity requires --scale-down-after-ready' in result.output
+    assert result.exit_code == 2
+
+
+def test_apply_autoscaling_warm_start(monkeypatch, mock_config):
+    kubectl_get = MagicMock(return_value={'items': [
+        {'status': {'replicas': 3}, 'spec': {'template': {'spec': {'containers': [
+            {'resources': {'requests': {'cpu': '250m'}}}, {'resources': {'requests': {'cpu': '0.25'}}}]}}}},
+        {'status': {'replicas': 1}},
+    ]})
+    request = MagicMock()
+    request.return_value.json.return_value = {'id': 'my-cr-id'}
+    monkeypatch.setattr('zalando_deploy_cli.cli.kubectl_login', MagicMock())
+    monkeypatch.setattr('zalando_deploy_cli.cli.kubectl_get', kubectl_get)
+    monkeypatch.setattr('zalando_deploy_cli.cli.kubectl_top_pods_cpu', lambda *args: 2400)
+    monkeypatch.setattr('zalando_deploy_cli.cli.request', request)
+    monkeypatch.setattr('zalando_deploy_cli.cli.approve_and_execute', MagicMock())
+    monkeypatch.setattr('time.sleep', MagicMock())
+
+    runner = CliRunner()
+    with runner.isolated_filesystem():
+        with open('hpa.yaml', 'w') as fd:
+            yaml.dump({'kind': 'HorizontalPodAutoscaler', 'metadata': {'name': '{{application}}'},
+                       'spec': {'minReplicas': 2, 'maxReplicas': 10, 'targetCPUUtilizationPercentage': 80}}, fd)
+        result = runner.invoke(cli, ['apply-autoscaling', 'hpa.yaml', 'myapp', 'v1', 'r1', '--execute',
+                                     '--warm-start', '--warm-start-window=60', '--warm-start-steps=2'])
+        # minReplicas would never be lowered again
+        invalid = runner.invoke(cli, ['apply-autoscaling', 'hpa.yaml', 'myapp', 'v1', 'r1', '--warm-start'])
+        assert invalid.exit_code == 2
+        assert '--warm-start requires --execute' in invalid.output
+
+    assert 'Starting autoscaler with 6 minimum replicas..' in result.output
+    assert 6 == request.call_args_list[0][1]['json']['spec']['minReplicas']
+    assert [4, 2] == [call[1]['json']['resources_update'][0]['operations'][0]['value']
+                      for call in request.call_args_list[1:]]
+
+    # e.g. CI job cancelled after the first step
+    request.reset_mock()
+    monkeypatch.setattr('time.sleep', MagicMock(side_effect=[None, KeyboardInterrupt]))
+    with runner.isolated_filesystem():
+        with open('hpa.yaml', 'w') as fd:
+            yaml.dump({'kind': 'HorizontalPodAutoscaler', 'metadata': {'name': '{{application}}'},
+                       'spec': {'minReplicas': 2, 'maxReplicas': 10, 'targetCPUUtilizationPercentage': 80}}, fd)
+        result = runner.invoke(cli, ['apply-autoscaling', 'hpa.yaml', 'myapp', 'v1', 'r1', '--execute',
+                                     '--warm-start', '--warm-start-window=60', '--warm-start-steps=2'])
+    assert result.exit_code == 1
+    assert 'autoscaler myapp keeps minReplicas=4 instead of 2' in result.output
+
+
+def test_completion_index(monkeypatch, mock_config, tmp_path):
+    monkeypatch.setattr('zalando_deploy_cli.completion.get_app_dir', lambda: str(tmp_path))
+    popen = MagicMock()
+    monkeypatch.setattr('subprocess.Popen', popen)
+    monkeypatch.setattr('zalando_deploy_cli.cli.kubectl_login', MagicMock())
+    deployments = {'items': [{'spec': {'template': {'metadata': {'labels': {
+        'application': 'myapp', 'version': 'v1', 'release': '3'}}}}}]}
+    monkeypatch.setattr('zalando_deploy_cli.cli.kubectl_get', MagicMock(return_value=deployments))
+    response = MagicMock(status_code=200)
+    response.json.return_value = {'items': [{'id': 'cr-1'}]}
+    monkeypatch.setattr('zalando_deploy_cli.cli.request', MagicMock(return_value=response))
+
+    # missing index: nothing to complete, refresh is started in the background (only once)
+    ctx = MagicMock(params={})
+    assert zalando_deploy_cli.cli.complete_application(ctx, None, '') == []
+    assert zalando_deploy_cli.cli.complete_application(ctx, None, '') == []
+    assert popen.call_count == 1
+
+    runner = CliRunner()
+    result = runner.invoke(cli, ['refresh-completion-index'], catch_exceptions=False)
+    assert result.exit_code == 0
+    assert not (tmp_path / 'completion-index.json.lock').exists()
+
+    ctx = MagicMock(params={'application': 'myapp', 'version': 'v1'})
+    assert zalando_deploy_cli.cli.complete_application(ctx, None, 'my') == ['myapp']
+    assert zalando_deploy_cli.cli.complete_version(ctx, None, '') == ['v1']
+    assert zalando_deploy_cli.cli.complete_release(ctx, None, '') == ['3']
+    assert zalando_deploy_cli.cli.complete_change_request_id(ctx, None, 'cr') == ['cr-1']
+    assert popen.call_count == 1
+
+
+def test_completion_index_refresh_failure(monkeypatch, mock_config, tmp_path):
+    monkeypatch.setattr('zalando_deploy_cli.completion.get_app_dir', lambda: str(tmp_path))
+    popen = MagicMock()
+    monkeypatch.setattr('subprocess.Popen', popen)
+    monkeypatch.setattr('zalando_deploy_cli.cli.kubectl_login', MagicMock(side_effect=Exception('offline')))
+
+    ctx = MagicMock(params={})
+    assert zalando_deploy_cli.cli.complete_application(ctx, None, '') == []
+    runner = CliRunner()
+    result = runner.invoke(cli, ['refresh-completion-index'])
+    assert result.exit_code != 0
+    # failed refresh is not retried on every completion
+    assert (tmp_path / 'completion-index.json.lock').exists()
+    assert zalando_deploy_cli.cli.complete_application(ctx, None, '') == []
+    assert popen.call_count == 1
+
+
+def test_request_compression(monkeypatch):
+    import gzip
+    monkeypatch.setattr('zign.api.get_token', lambda a, b: 'mytok')
+    monkeypatch.setattr('zalando_deploy_cli.cli._uncompressed_apis', set())
+    config = {'deploy_api': 'https://deploy.example.org', 'compress_requests': True, 'compression_threshold': 100}
+    post = MagicMock(return_value=MagicMock(status_code=201))
+    data = {'Resources': {'Res{}'.format(i): {'Type': 'AWS::SNS::Topic'} for i in range(100)}}
+
+    # small bodies are not compressed
+    zalando_deploy_cli.cli.request(config, post, '/foo', json={'a': 1})
+    assert 'Content-Encoding' not in post.call_args[1]['headers']
+    assert json.loads(post.call_args[1]['data'].decode('utf-8')) == {'a': 1}
+
+    zalando_deploy_cli.cli.request(config, post, '/foo', json=data)
+    assert post.call_args[1]['headers']['Content-Encoding'] == 'gzip'
+    assert json.loads(gzip.decompress(post.call_args[1]['data']).decode('utf-8')) == data
+
+    # server does not support compression: retry uncompressed and do not try again
+    post.reset_mock()
+    post.side_effect = [MagicMock(status_code=415), MagicMock(status_code=201)]
+    zalando_deploy_cli.cli.request(config, post, '/foo', json=data)
+    assert post.call_count == 2
+    assert json.loads(post.call_args[1]['data'].decode('utf-8')) == data
+    assert 'Content-Encoding' not in post.call_args[1]['headers']
+    post.side_effect = None
+    zalando_deploy_cli.cli.request(config, post, '/foo', json=data)
+    assert post.call_count == 3
+    assert post.call_args[1]['json'] == data
+
+
+def test_wait_for_stack(monkeypatch, mock_config):
+    monkeypatch.setattr('zign.api.get_token', lambda a, b: 'mytok')
+    monkeypatch.setattr('time.sleep', MagicMock())
+
+    def event(id_, resource, status, type_='AWS::EC2::Instance'):
+        return {'EventId': id_, 'LogicalResourceId': resource, 'ResourceType': type_, 'ResourceStatus': status}
+
+    stack = 'AWS::CloudFormation::Stack'
+    polls = [
+        # newest first, includes the previous stack operation
+        [event('3', 'Server', 'CREATE_IN_PROGRESS'),
+         event('2', 'mystack', 'UPDATE_IN_PROGRESS', stack),
+         event('1', 'mystack', 'CREATE_COMPLETE', stack)],
+        [],
+        [event('5', 'mystack', 'UPDATE_COMPLETE', stack),
+         event('4', 'Server', 'CREATE_COMPLETE'),
+         event('3', 'Server', 'CREATE_IN_PROGRESS')]
+    ]
+    responses = [MagicMock(status_code=200, **{'json.return_value': {'items': items}}) for items in polls]
+    get = MagicMock(side_effect=responses)
+    monkeypatch.setattr('requests.get', get)
+    monkeypatch.setattr('zalando_deploy_cli.cli.pooled', lambda method: method)
+
+    runner = CliRunner()
+    result = runner.invoke(cli, ['wait-for-stack', 'mystack'], catch_exceptions=False)
+    assert result.exit_code == 0
+    assert 'CREATE_COMPLETE' not in result.output.split('Server')[0]
+    assert result.output.count('Server') == 2
+    assert 'Stack mystack complete.' in result.output
+    assert get.call_args_list[1][1]['params'] == {'after': '3'}
+    assert get.call_args_list[2][1]['params'] == {'after': '3'}
+
+    # previous operation already finished: its result is not reported, wait for the new operation
+    polls = [
+        [event('5', 'mystack', 'UPDATE_COMPLETE', stack)],
+        [event('7', 'mystack', 'UPDATE_ROLLBACK_COMPLETE', stack),
+         event('6', 'mystack', 'UPDATE_IN_PROGRESS', stack),
+         event('5', 'mystack', 'UPDATE_COMPLETE', stack)]
+    ]
+    responses = [MagicMock(status_code=200, **{'json.return_value': {'items': items}}) for items in polls]
+    get = MagicMock(side_effect=responses)
+    monkeypatch.setattr('requests.get', get)
+    result = runner.invoke(cli, ['wait-for-stack', 'mystack'], catch_exceptions=False)
+    assert result.exit_code == 1
+    assert 'Waiting for new operation of stack mystack' in result.output
+    assert get.call_args_list[1][1]['params'] == {'after': '5'}
+
+    # operation finished just before waiting started (or had nothing to update), a delete is a success
+    for status, exit_code in ('UPDATE_COMPLETE', 0), ('DELETE_COMPLETE', 0), ('UPDATE_ROLLBACK_COMPLETE', 1):
+        recent = dict(event('9', 'mystack', status, stack),
+                      Timestamp=time.strftime('%Y-%m-%dT%H:%M:%S.123Z', time.gmtime(time.time() - 30)))
+        get = MagicMock(return_value=MagicMock(status_code=200, **{'json.return_value': {'items': [recent]}}))
+        monkeypatch.setattr('requests.get', get)
+        result = runner.invoke(cli, ['wait-for-stack', 'mystack'], catch_exceptions=False)
+        assert result.exit_code == exit_code
+        assert get.call_count == 1
+
+
+def test_approve_and_execute_wait_timeout(monkeypatch, capsys):
+    monkeypatch.setattr('zalando_deploy_cli.cli.request', MagicMock())
+    monkeypatch.setattr('zalando_deploy_cli.cli.wait_for_change_requests', lambda config, ids: {'my-cr-id': None})
+    with pytest.raises(SystemExit) as exc_info:
+        zalando_deploy_cli.cli.approve_and_execute({}, 'my-cr-id', wait=True)
+    assert exc_info.value.code == 1
+    assert 'Timeout waiting for change request(s) my-cr-id' in capsys.readouterr().err
+
+
+def test_wait_for_change_request_timeout(monkeypatch, mock_config):
+    monkeypatch.setattr('zalando_deploy_cli.cli.request', MagicMock())
+    monkeypatch.setattr('zalando_deploy_cli.cli.wait_for_change_requests',
+                        lambda config, ids, **kwargs: {'cr-1': 'executed', 'cr-2': None, 'cr-3': None})
+    runner = CliRunner()
+    result = runner.invoke(cli, ['wait-for-change-request', 'cr-1', 'cr-2', 'cr-3'])
+    assert 'Timeout waiting for change request(s) cr-2, cr-3' in result.output
+    assert result.exit_code == 1
+    result = runner.invoke(cli, ['execute-change-request', 'cr-1', 'cr-2', 'cr-3', '--wait'])
+    assert 'Timeout waiting for change request(s) cr-2, cr-3' in result.output
+    assert result.exit_code == 1
+
+
+def test_get_token_serialized(monkeypatch):
+    import threading
+    active = []
+    concurrency = []
+
+    def get_token(name, scopes):
+        active.append(1)
+        concurrency.append(len(active))
+        time.sleep(0.01)
+        active.pop()
+        return 'mytok'
+    monkeypatch.setattr('zign.api.get_token', get_token)
+
+    threads = [threading.Thread(target=zalando_deploy_cli.cli.get_token) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert concurrency == [1] * 8
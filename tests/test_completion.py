@@ -0,0 +1,39 @@
+import json
+import time
+
+import click
+from zalando_deploy_cli import completion
+from zalando_deploy_cli.cli import cli
+
+
+def test_command_arguments_match_cli():
+    expected = {}
+    for name, command in cli.commands.items():
+        kinds = []
+        for param in command.params:
+            if isinstance(param, click.Argument):
+                callback = getattr(param, '_custom_shell_complete', None)
+                kind = callback.__name__[len('complete_'):] if callback else None
+                kinds.append(kind + '*' if kind and param.nargs == -1 else kind)
+        while kinds and kinds[-1] is None:
+            kinds.pop()
+        if kinds:
+            expected[name] = tuple(kinds)
+    assert completion.COMMAND_ARGUMENTS == expected
+
+
+def test_complete(monkeypatch, tmp_path):
+    monkeypatch.setattr('zalando_deploy_cli.completion.get_app_dir', lambda: str(tmp_path))
+    index = {'updated': time.time(), 'applications': {'myapp': {'v1': ['1', '2']}, 'other': {}},
+             'change_requests': ['cr-1', 'cr-2']}
+    (tmp_path / 'completion-index.json').write_text(json.dumps(index))
+
+    assert completion.complete('bash_complete', 'zdeploy -o json wait-for-deployment my', '4') == 'plain,myapp\n'
+    assert completion.complete('bash_complete', 'zdeploy wait-for-deployment myapp v1 ', '4') == 'plain,1\nplain,2\n'
+    assert completion.complete('zsh_complete', 'zdeploy get-change-request cr-1 c', '3') == \
+        'plain\ncr-1\n_\nplain\ncr-2\n_\n'
+    # file arguments, options, prefixes and other shells are completed by click
+    assert completion.complete('bash_complete', 'zdeploy create-deployment ', '2') is None
+    assert completion.complete('bash_complete', 'zdeploy switch-deployment --execute ', '3') is None
+    assert completion.complete('bash_complete', 'zdeploy wait-for-dep ', '2') is None
+    assert completion.complete('fish_complete', 'zdeploy wait-for-deployment ', '2') is None
@@ -34,3 +34,47 @@ def test_init_from_senza():
         for path in Path('.').iterdir():
             print(path)
     print(result.output)
+
+
+def test_migrate_senza():
+    runner = CliRunner()
+
+    senza_file = Path(__file__).parent / 'fixtures' / 'senza-helloworld.yaml'
+
+    with runner.isolated_filesystem():
+        Path('senza').mkdir()
+        Path('senza/helloworld.yaml').write_text(senza_file.read_text())
+        Path('senza/broken.yaml').write_text('SenzaInfo: {StackName: foo}\n')
+
+        result = runner.invoke(cli, ['migrate-senza', 'senza', '--kubernetes-cluster=aws:123:my-region:my-kube',
+                                     '--output-directory=out'])
+
+        assert 'Senza file has no property "SenzaComponents"' in result.output
+        assert result.exit_code == 1
+        deployment = Path('out/helloworld/deployment.yaml').read_text()
+        assert 'image: "pierone.stups.zalan.do/mentoring/hjacobs-helloworld:{{ version }}"' in deployment
+        assert 'aws:123:my-region:my-kube' in Path('out/helloworld/pipeline.yaml').read_text()
+        assert not Path('out/broken').exists()
+
+        # Senza files with the same name in different folders would write to the same deploy folder
+        Path('other').mkdir()
+        Path('other/helloworld.yaml').write_text(senza_file.read_text())
+        result = runner.invoke(cli, ['migrate-senza', 'senza/helloworld.yaml', 'other/helloworld.yaml',
+                                     '--kubernetes-cluster=aws:123:my-region:my-kube', '--output-directory=out2'])
+        assert result.output.count('Deploy folder is the same for several Senza files') == 2
+        assert result.exit_code == 1
+        assert not Path('out2/helloworld').exists()
+
+
+def test_read_senza_variables_resources():
+    senza_file = Path(__file__).parent / 'fixtures' / 'senza-helloworld.yaml'
+
+    with senza_file.open() as fd:
+        variables = zalando_deploy_cli.cli.read_senza_variables(fd)
+    assert {'cpu_request': '500m', 'cpu_limit': '1000m',
+            'memory_request': '512Mi', 'memory_limit': '512Mi'}.items() <= variables.items()
+
+    with senza_file.open() as fd:
+        variables = zalando_deploy_cli.cli.read_senza_variables(fd, headroom=0.25)
+    assert '750m' == variables['cpu_request']
+    assert '768Mi' == variables['memory_limit']
@@ -0,0 +1,53 @@
+import json
+from unittest.mock import MagicMock
+
+from click.testing import CliRunner
+from zalando_deploy_cli import metrics
+from zalando_deploy_cli.cli import cli
+
+
+def test_get_endpoint():
+    assert metrics.get_endpoint('get', '/change-requests/abc123?x=1') == 'GET /change-requests/{id}'
+    assert metrics.get_endpoint('put', '/aws-accounts/aws:123/regions/eu-central-1/cloudformation-stacks/mystack') == \
+        'PUT /aws-accounts/{id}/regions/{id}/cloudformation-stacks/mystack'
+
+
+def test_flush_and_rotate(monkeypatch, tmp_path):
+    monkeypatch.setattr('zalando_deploy_cli.metrics._enabled', True)
+    monkeypatch.setattr('zalando_deploy_cli.metrics._samples', [])
+    monkeypatch.setattr('zalando_deploy_cli.metrics.MAX_HISTORY_SIZE', 200)
+    textfile = tmp_path / 'zdeploy.prom'
+    for i in range(5):
+        with metrics.timer('request', endpoint='GET /foo') as labels:
+            labels['status'] = 200
+        metrics.flush(str(tmp_path), str(textfile))
+    assert (tmp_path / 'metrics.ndjson.1').exists()
+    # history is bounded, totals are cumulative
+    assert len(list(metrics.load_history(str(tmp_path)))) < 5
+    contents = textfile.read_text()
+    assert '# TYPE zdeploy_operation_duration_seconds histogram' in contents
+    assert ('zdeploy_operation_duration_seconds_count{endpoint="GET /foo",operation="request",status="200"} 5'
+            in contents)
+    assert 'le="+Inf"} 5' in contents
+
+
+def test_stats(monkeypatch, tmp_path):
+    monkeypatch.setattr('click.get_app_dir', lambda name: str(tmp_path))
+    monkeypatch.setattr('stups_cli.config.load_config', lambda section: {'metrics': True})
+    monkeypatch.setattr('zalando_deploy_cli.metrics._enabled', False)
+    monkeypatch.setattr('zalando_deploy_cli.metrics._samples', [])
+    monkeypatch.setattr('zalando_deploy_cli.cli.kubectl_login', MagicMock())
+    kubectl_get_columns = MagicMock(side_effect=lambda *args: iter([('Running', 'true')]))
+    monkeypatch.setattr('zalando_deploy_cli.cli.kubectl_get_columns', kubectl_get_columns)
+    monkeypatch.setattr('time.sleep', MagicMock())
+
+    runner = CliRunner()
+    for i in range(3):
+        result = runner.invoke(cli, ['wait-for-deployment', 'myapp', 'v1', 'r1'], catch_exceptions=False)
+        assert result.exit_code == 0
+
+    result = runner.invoke(cli, ['-o', 'ndjson', 'stats', '--operation', 'command'], catch_exceptions=False)
+    rows = [json.loads(line) for line in result.output.splitlines()]
+    assert len(rows) == 1
+    assert rows[0]['labels'] == 'command=wait-for-deployment'
+    assert rows[0]['count'] == 3
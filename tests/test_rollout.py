@@ -0,0 +1,55 @@
+import json
+from unittest.mock import MagicMock
+
+from click.testing import CliRunner
+from zalando_deploy_cli import rollout, utils
+from zalando_deploy_cli.cli import cli
+
+
+def pod(name, scheduled, started, ready):
+    return {
+        'metadata': {'name': name, 'creationTimestamp': '2017-01-01T12:00:00Z'},
+        'status': {
+            'conditions': [
+                {'type': 'PodScheduled', 'status': 'True',
+                 'lastTransitionTime': '2017-01-01T12:00:{:02d}Z'.format(scheduled)},
+                {'type': 'Ready', 'status': 'True' if ready else 'False',
+                 'lastTransitionTime': '2017-01-01T12:00:{:02d}Z'.format(ready or 0)}],
+            'containerStatuses': [
+                {'name': 'app', 'state': {'running': {'startedAt': '2017-01-01T12:00:{:02d}Z'.format(started)}}},
+                {'name': 'sidecar', 'state': {'running': {'startedAt': '2017-01-01T12:00:01Z'}}}]
+        }
+    }
+
+
+def test_get_report():
+    pods = [pod('p{}'.format(i), 1, 10 + i, 20 + i) for i in range(10)] + [pod('pending', 2, 5, None)]
+    report = rollout.get_report(pods)
+    assert report['summary'] == [
+        {'phase': 'scheduled', 'pods': 11, 'p50': 1, 'p95': 2, 'max': 2},
+        {'phase': 'started', 'pods': 11, 'p50': 14, 'p95': 19, 'max': 19},
+        {'phase': 'ready', 'pods': 10, 'p50': 24, 'p95': 29, 'max': 29}]
+    assert [row['pod'] for row in report['slowest_pods']] == ['p9', 'p8', 'p7']
+    assert report['slowest_containers'][0] == {'pod': 'p9', 'container': 'app', 'started': 19}
+    assert utils.percentile([], 50) is None
+
+
+def test_wait_for_deployment_report(monkeypatch):
+    monkeypatch.setattr('stups_cli.config.load_config', lambda section: {'kubernetes_namespace': 'default'})
+    monkeypatch.setattr('zalando_deploy_cli.cli.kubectl_login', MagicMock())
+    kubectl_get_columns = MagicMock(return_value=iter([('Running', 'true')]))
+    monkeypatch.setattr('zalando_deploy_cli.cli.kubectl_get_columns', kubectl_get_columns)
+    kubectl_get = MagicMock(return_value={'items': [pod('myapp-1', 3, 7, 12)]})
+    monkeypatch.setattr('zalando_deploy_cli.cli.kubectl_get', kubectl_get)
+
+    runner = CliRunner()
+    result = runner.invoke(cli, ['wait-for-deployment', 'myapp', 'v1', 'r1', '--report'], catch_exceptions=False)
+    assert result.exit_code == 0
+    assert 'Slowest pods' in result.output
+    assert '12s' in result.output
+
+    kubectl_get_columns = MagicMock(return_value=iter([('Running', 'true')]))
+    monkeypatch.setattr('zalando_deploy_cli.cli.kubectl_get_columns', kubectl_get_columns)
+    result = runner.invoke(cli, ['-o', 'json', 'wait-for-deployment', 'myapp', 'v1', 'r1', '--report'],
+                           catch_exceptions=False)
+    assert json.loads(result.output)['slowest_pods'][0]['ready'] == 12
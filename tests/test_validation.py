@@ -0,0 +1,56 @@
+import json
+from unittest.mock import MagicMock
+
+from click.testing import CliRunner
+from zalando_deploy_cli import validation
+from zalando_deploy_cli.cli import cli, validate_templates
+
+
+def test_validate_manifest():
+    deployment = {
+        'apiVersion': 'extensions/v1beta1',
+        'kind': 'Deployment',
+        'metadata': {'name': 'my-app-v1-r1', 'labels': {'version': 1.0}},
+        'spec': {'replicas': '3', 'template': {'spec': {'containers': [{'name': 'my-app'}]}}}
+    }
+    assert ['metadata.labels.version: expected string, got number',
+            'spec.replicas: expected integer, got string',
+            'spec.template.spec.containers[0]: missing required property "image"'] == sorted(
+        validation.validate_manifest(deployment))
+
+    stack = {'Metadata': {'StackName': 'my-stack'}, 'Resources': {'Queue': {'Type': 'AWS::SQS::Queue'}}}
+    assert [] == validation.validate_manifest(stack)
+    assert ['Neither a Kubernetes manifest nor a Cloud Formation template'] == validation.validate_manifest({})
+
+
+def test_load_schemas_cache(tmp_path):
+    schemas = validation.load_schemas(str(tmp_path))
+    cache_files = list(tmp_path.iterdir())
+    assert 1 == len(cache_files)
+    assert schemas == json.loads(cache_files[0].read_text())
+    assert schemas == validation.load_schemas(str(tmp_path))
+
+
+def test_validate_command(tmp_path):
+    (tmp_path / 'service.yaml').write_text(
+        'apiVersion: v1\nkind: Service\nmetadata: {name: "{{application}}"}\nspec: {ports: [{port: 80}]}\n')
+    (tmp_path / 'stack.yaml').write_text('Metadata: {StackName: "{{application}}"}\nResources: {}\n')
+
+    runner = CliRunner()
+    result = runner.invoke(cli, ['validate', str(tmp_path), 'application=myapp'])
+    assert 'stack.yaml: Resources: must have at least 1 properties' in result.output
+    assert 'service.yaml' not in result.output
+    assert result.exit_code == 1
+
+
+def test_validate_templates_serial_for_few_templates(monkeypatch, tmp_path):
+    pool = MagicMock()
+    monkeypatch.setattr('concurrent.futures.ProcessPoolExecutor', pool)
+    paths = []
+    for i in range(3):
+        path = tmp_path / 'service{}.yaml'.format(i)
+        path.write_text('apiVersion: v1\nkind: Service\nmetadata: {name: svc}\nspec: {ports: [{port: 80}]}\n')
+        paths.append(str(path))
+    assert validate_templates(paths, {}) == dict.fromkeys(paths, [])
+    assert validate_templates(paths, {}, jobs=None) == dict.fromkeys(paths, [])
+    assert not pool.called
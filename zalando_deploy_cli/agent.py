@@ -0,0 +1,145 @@
+'''
+Optional local agent to keep sessions warm across CLI invocations
+
+The agent listens on a Unix socket and runs forwarded CLI invocations in its own (long-running) process,
+i.e. imported modules, pooled HTTP connections and Kubernetes logins survive between calls.
+'''
+import contextlib
+import io
+import json
+import os
+import socket
+import socketserver
+import sys
+import threading
+
+# maximum size of a single forwarded request/response (bytes)
+MAX_MESSAGE_SIZE = 64 * 1024 * 1024
+
+# clients give up (and run the command themselves) if the agent does not accept the connection in time
+CONNECT_TIMEOUT = 5  # seconds
+
+
+def _receive(sock):
+    chunks = []
+    size = 0
+    while True:
+        chunk = sock.recv(65536)
+        if not chunk:
+            break
+        size += len(chunk)
+        if size > MAX_MESSAGE_SIZE:
+            raise ValueError('Message too large')
+        chunks.append(chunk)
+    return json.loads(b''.join(chunks).decode('utf-8'))
+
+
+def _send(sock, data):
+    sock.sendall(json.dumps(data).encode('utf-8'))
+    sock.shutdown(socket.SHUT_WR)
+
+
+@contextlib.contextmanager
+def _environment(cwd, env):
+    '''Temporarily switch working directory and environment to the ones of the calling process'''
+    old_cwd = os.getcwd()
+    old_env = dict(os.environ)
+    try:
+        os.chdir(cwd)
+        os.environ.clear()
+        os.environ.update(env)
+        yield
+    finally:
+        os.environ.clear()
+        os.environ.update(old_env)
+        os.chdir(old_cwd)
+
+
+def run_forwarded(handler, args: list, cwd: str, env: dict):
+    '''Run handler(args) like a CLI process would, capturing its output and exit code'''
+    stdout = io.StringIO()
+    stderr = io.StringIO()
+    exit_code = 0
+    with _environment(cwd, env), \
+            contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+        old_stdin = sys.stdin
+        sys.stdin = io.StringIO()
+        try:
+            handler(args)
+        except SystemExit as e:
+            if isinstance(e.code, int):
+                exit_code = e.code
+            elif e.code is not None:
+                print(e.code, file=sys.stderr)
+                exit_code = 1
+        except Exception as e:
+            print('Agent failed to execute command: {}'.format(e), file=sys.stderr)
+            exit_code = 1
+        finally:
+            sys.stdin = old_stdin
+    return {'exit_code': exit_code, 'stdout': stdout.getvalue(), 'stderr': stderr.getvalue()}
+
+
+class _RequestHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        request = _receive(self.request)
+        # forwarded commands switch process-wide state (working directory, environment, stdout),
+        # i.e. only one can run at a time: tell other clients to run their command themselves
+        if not self.server.lock.acquire(blocking=False):
+            _send(self.request, {'busy': True})
+            return
+        try:
+            response = run_forwarded(self.server.handler, request['args'], request['cwd'], request['env'])
+        finally:
+            self.server.lock.release()
+        _send(self.request, response)
+
+
+class AgentServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    '''Unix socket server running one forwarded CLI invocation at a time
+
+    Connections are accepted concurrently, so clients arriving while the agent is busy
+    get an immediate "busy" response instead of waiting.'''
+
+    daemon_threads = True
+
+    def __init__(self, socket_path: str, handler):
+        self.handler = handler
+        self.lock = threading.Lock()
+        directory = os.path.dirname(socket_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        if os.path.exists(socket_path):
+            # stale socket of a previous agent
+            os.unlink(socket_path)
+        old_umask = os.umask(0o077)
+        try:
+            super().__init__(socket_path, _RequestHandler)
+        finally:
+            os.umask(old_umask)
+
+    def server_close(self):
+        super().server_close()
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(self.server_address)
+
+
+def forward(socket_path: str, args: list):
+    '''Forward CLI invocation to a running agent
+
+    Returns the agent's response or None if no agent is running or the agent is busy.'''
+    if not os.path.exists(socket_path):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.settimeout(CONNECT_TIMEOUT)
+        try:
+            sock.connect(socket_path)
+        except (ConnectionRefusedError, FileNotFoundError, socket.timeout):
+            return None
+        _send(sock, {'args': list(args), 'cwd': os.getcwd(), 'env': dict(os.environ)})
+        sock.settimeout(None)
+        response = _receive(sock)
+        return None if response.get('busy') else response
+    finally:
+        sock.close()
@@ -1,10 +1,21 @@
+import calendar
+import codecs
+import collections
+import concurrent.futures
+import contextlib
+import glob
+import gzip
+import hashlib
+import io
 import json
+import math
 import os
 import re
 import string
 import subprocess
 import sys
 import textwrap
+import threading
 import time
 import urllib.parse
 from pathlib import Path
@@ -16,7 +27,9 @@ import requests
 import stups_cli.config
 import yaml
 import zign.api
-from clickclick import Action, AliasedGroup, error, info, print_table
+from clickclick import Action, AliasedGroup, OutputFormat, error, info, print_table, warning
+
+from . import agent, completion, instance_types, metrics, rollout, validation
 
 CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
 
@@ -28,17 +41,48 @@ VERSION_PATTERN = re.compile('^[a-z0-9][a-z0-9.-]*$')
 
 DEFAULT_HTTP_TIMEOUT = 30  # seconds
 
-# EC2 instance memory in MiB
-EC2_INSTANCE_MEMORY = {
-    't2.nano': 500,
-    't2.micro': 1000,
-    't2.small': 2000,
-    't2.medium': 4000,
-    'm3.medium': 3750,
-    'm4.large': 8000,
-    'c4.large': 3750,
-    'c4.xlarge': 7500
-}
+# request bodies of at least this size are sent gzip compressed if "compress_requests" is configured
+DEFAULT_COMPRESSION_THRESHOLD = 16 * 1024  # bytes
+
+# fraction of EC2 instance CPU/memory not given to the container when converting Senza definitions
+DEFAULT_SENZA_HEADROOM = 0.5
+
+# a running agent (see "agent" command) re-uses logins for this time
+KUBECTL_LOGIN_TTL = 600  # seconds
+
+# change request states which will not change anymore
+CHANGE_REQUEST_FAILED_STATES = frozenset(['failed', 'error', 'rejected'])
+
+# "apply --watch" checks templates for modifications in this interval
+WATCH_INTERVAL = 0.5  # seconds
+# ..and waits until a burst of modifications settled
+WATCH_DEBOUNCE = 1  # seconds
+
+# annotation with content hash of the submitted manifest (see "apply --skip-unchanged")
+LAST_APPLIED_HASH_ANNOTATION = 'zalando-deploy-cli/last-applied-hash'
+
+# version of the "bundle" file format
+BUNDLE_FORMAT = 1
+# stages of a deploy folder (see "init") in order of submission
+BUNDLE_STAGES = ('apply', 'deployment', 'autoscaling')
+
+# "validate" uses parallel processes (unless given --jobs) only for at least this many templates
+PARALLEL_VALIDATION_MIN_TEMPLATES = 50
+
+# final Cloud Formation stack states (see "wait-for-stack")
+STACK_COMPLETE_STATES = frozenset(['CREATE_COMPLETE', 'UPDATE_COMPLETE', 'IMPORT_COMPLETE', 'DELETE_COMPLETE'])
+STACK_FAILED_STATES = frozenset(['CREATE_FAILED', 'ROLLBACK_COMPLETE', 'ROLLBACK_FAILED',
+                                 'DELETE_FAILED', 'UPDATE_ROLLBACK_COMPLETE', 'UPDATE_ROLLBACK_FAILED',
+                                 'IMPORT_ROLLBACK_COMPLETE', 'IMPORT_ROLLBACK_FAILED'])
+# stack operations finished at most this long before "wait-for-stack" started are reported (not waited for)
+DEFAULT_STACK_EVENT_MAX_AGE = 120  # seconds
+STACK_EVENT_TIMESTAMP_PATTERN = re.compile(r'^(\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d)(\.\d+)?(Z|[+-]00:?00)?$')
+
+# commands reading from stdin, prompting the user or running for a long time are never forwarded to the agent
+AGENT_LOCAL_COMMANDS = frozenset(['agent', 'encrypt', 'init', 'wait-for-change-request', 'wait-for-deployment',
+                                  'wait-for-stack'])
+# same for any command with one of these (waiting/watching) options
+AGENT_LOCAL_OPTIONS = frozenset(['--wait', '--watch', '--scale-down-after-ready', '--warm-start'])
 
 
 def find_latest_docker_image_version(image):
@@ -46,7 +90,7 @@ def find_latest_docker_image_version(image):
     if not docker_image.registry:
         error('Could not resolve "latest" tag for {}: missing registry.'.format(image))
         exit(2)
-    token = zign.api.get_token('uid', ['uid'])
+    token = get_token()
     latest_tag = pierone.api.get_latest_tag(docker_image, token)
     if not latest_tag:
         error('Could not resolve "latest" tag for {}'.format(image))
@@ -62,13 +106,80 @@ def validate_pattern(pattern):
     return validate
 
 
-application_argument = click.argument('application', callback=validate_pattern(APPLICATION_PATTERN))
-version_argument = click.argument('version', callback=validate_pattern(VERSION_PATTERN))
-release_argument = click.argument('release', callback=validate_pattern(VERSION_PATTERN))
+def complete_application(ctx, param, incomplete):
+    return completion.get_completions('application', ctx.params, incomplete)
+
+
+def complete_version(ctx, param, incomplete):
+    return completion.get_completions('version', ctx.params, incomplete)
+
+
+def complete_release(ctx, param, incomplete):
+    return completion.get_completions('release', ctx.params, incomplete)
+
+
+def complete_change_request_id(ctx, param, incomplete):
+    return completion.get_completions('change_request_id', ctx.params, incomplete)
+
+
+application_argument = click.argument('application', callback=validate_pattern(APPLICATION_PATTERN),
+                                      shell_complete=complete_application)
+version_argument = click.argument('version', callback=validate_pattern(VERSION_PATTERN),
+                                  shell_complete=complete_version)
+release_argument = click.argument('release', callback=validate_pattern(VERSION_PATTERN),
+                                  shell_complete=complete_release)
+wait_option = click.option('--wait', is_flag=True, help='Wait until the change request was executed')
+
+
+_session = None
+# concurrent requests (e.g. --target, encrypt --batch) must not start several OAuth flows at once
+_token_lock = threading.Lock()
+# most recent "zkubectl login" of this (agent) process: (login key, time)
+_kubectl_login = (None, 0)
+# deploy API URLs which rejected compressed request bodies
+_uncompressed_apis = set()
+
+
+def get_token():
+    '''Get OAuth token, only one thread at a time (following threads get the token cached by zign)'''
+    with _token_lock:
+        return zign.api.get_token('uid', ['uid'])
+
+
+def get_session():
+    '''Get shared HTTP session to re-use pooled connections'''
+    global _session
+    if _session is None:
+        _session = requests.Session()
+        # response bodies are decoded on the fly while streaming (iter_content/json)
+        _session.headers['Accept-Encoding'] = 'gzip, deflate'
+    return _session
+
+
+def pooled(method):
+    '''Map module level functions like requests.get to the shared session'''
+    if getattr(method, '__module__', None) == 'requests.api':
+        return getattr(get_session(), method.__name__)
+    return method
+
+
+def get_compressed_body(config: dict, headers: dict, kwargs: dict):
+    '''Return gzip compressed JSON request body if compression is enabled and worth it, None otherwise
+
+    The (uncompressed) JSON body is moved from "json" to "data" in kwargs so it can be re-sent as is.'''
+    if not config.get('compress_requests') or 'json' not in kwargs or config.get('deploy_api') in _uncompressed_apis:
+        return None
+    body = json.dumps(kwargs.pop('json')).encode('utf-8')
+    headers['Content-Type'] = 'application/json'
+    kwargs['data'] = body
+    if len(body) < int(config.get('compression_threshold') or DEFAULT_COMPRESSION_THRESHOLD):
+        return None
+    return gzip.compress(body, compresslevel=6)
 
 
 def request(config: dict, method, path: str, headers=None, exit_on_error=True, **kwargs):
-    token = zign.api.get_token('uid', ['uid'])
+    method = pooled(method)
+    token = get_token()
     if not headers:
         headers = {}
     headers['Authorization'] = 'Bearer {}'.format(token)
@@ -76,7 +187,23 @@ def request(config: dict, method, path: str, headers=None, exit_on_error=True, *
         headers['X-On-Behalf-Of'] = config['user']
     api_url = config.get('deploy_api')
     url = urllib.parse.urljoin(api_url, path)
-    response = method(url, headers=headers, timeout=DEFAULT_HTTP_TIMEOUT, **kwargs)
+    compressed_body = get_compressed_body(config, headers, kwargs)
+    endpoint = metrics.get_endpoint(getattr(method, '__name__', 'request'), path)
+    with metrics.timer('request', endpoint=endpoint) as labels:
+        if compressed_body is not None:
+            response = method(url, headers=dict(headers, **{'Content-Encoding': 'gzip'}),
+                              timeout=DEFAULT_HTTP_TIMEOUT, **dict(kwargs, data=compressed_body))
+            if response.status_code != 415:
+                labels['status'] = response.status_code
+                return check_response(response, url, exit_on_error)
+            # server does not support compressed bodies: send uncompressed from now on
+            _uncompressed_apis.add(api_url)
+        response = method(url, headers=headers, timeout=DEFAULT_HTTP_TIMEOUT, **kwargs)
+        labels['status'] = response.status_code
+    return check_response(response, url, exit_on_error)
+
+
+def check_response(response, url: str, exit_on_error: bool):
     if exit_on_error:
         if not (200 <= response.status_code < 400):
             error('Server returned HTTP error {} for {}:\n{}'.format(response.status_code, url, response.text))
@@ -95,9 +222,61 @@ def execute(config, change_request_id):
     request(config, requests.post, path)
 
 
-def approve_and_execute(config, change_request_id):
+def approve_and_execute(config, change_request_id, wait=False):
     approve(config, change_request_id)
     execute(config, change_request_id)
+    if wait:
+        states = wait_for_change_requests(config, [change_request_id])
+        report_change_request_timeouts(states)
+        if states[change_request_id] != 'executed':
+            exit(1)
+
+
+def report_change_request_timeouts(states: dict):
+    '''Print error for all change requests still pending (see wait_for_change_requests)'''
+    pending = [id_ for id_, state in states.items() if state is None]
+    if pending:
+        error('Timeout waiting for change request(s) {} to be executed'.format(', '.join(pending)))
+
+
+def get_change_request_state(data: dict):
+    '''Return "executed", "failed" or None (still pending) for the given change request'''
+    status = str(data.get('status') or '').lower()
+    if status in CHANGE_REQUEST_FAILED_STATES:
+        return 'failed'
+    if data.get('executed') or status == 'executed':
+        return 'executed'
+    return None
+
+
+def wait_for_change_requests(config, change_request_ids, timeout=600, interval=2, max_interval=30):
+    '''Poll all given change requests concurrently until they reached a final state
+
+    The poll interval grows by 50% for every poll without any change.
+    Returns a dict mapping each change request ID to its final state (or None on timeout).'''
+    states = dict.fromkeys(change_request_ids)
+
+    def poll(id_):
+        response = request(config, requests.get, '/change-requests/{}'.format(id_))
+        return id_, get_change_request_state(response.json())
+
+    cutoff = time.time() + timeout
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(len(states), 16) or 1) as executor:
+        while True:
+            pending = [id_ for id_, state in states.items() if state is None]
+            changed = False
+            for id_, state in executor.map(poll, pending):
+                if state:
+                    info('Change request {} {}.'.format(id_, state))
+                    states[id_] = state
+                    changed = True
+            pending = [id_ for id_, state in states.items() if state is None]
+            if not pending or time.time() >= cutoff:
+                break
+            interval = interval if changed else min(interval * 1.5, max_interval)
+            info('Waiting up to {:.0f} more secs for {} change request(s)..'.format(cutoff - time.time(), len(pending)))
+            time.sleep(min(interval, max(cutoff - time.time(), 0)))
+    return states
 
 
 def parse_parameters(parameter):
@@ -108,6 +287,7 @@ def parse_parameters(parameter):
     return context
 
 
+@metrics.timed('render_template')
 def _render_template(template, context):
     contents = template.read()
     rendered_contents = pystache.render(contents, context)
@@ -115,6 +295,193 @@ def _render_template(template, context):
     return data
 
 
+def _render_parsed_template(parsed_template, context):
+    rendered_contents = pystache.render(parsed_template, context)
+    data = yaml.safe_load(rendered_contents)
+    return data
+
+
+def _validate_template_file(path, context):
+    try:
+        with open(path, 'r') as fd:
+            data = _render_template(fd, context)
+    except (OSError, yaml.YAMLError) as e:
+        return path, [str(e)]
+    return path, validation.validate_manifest(data, click.get_app_dir('zalando-deploy-cli'))
+
+
+def validate_templates(template_paths, context, jobs=1):
+    '''Render and validate templates, returns dict path -> errors
+
+    Uses parallel processes for jobs > 1 or for jobs=None (number of CPUs) if there are many templates:
+    starting worker processes takes longer than validating a typical deploy folder.'''
+    contexts = [context] * len(template_paths)
+    if jobs is None and len(template_paths) < PARALLEL_VALIDATION_MIN_TEMPLATES:
+        jobs = 1
+    if len(template_paths) < 2 or jobs == 1:
+        return dict(map(_validate_template_file, template_paths, contexts))
+    # compile schemas once before forking the worker processes
+    validation.get_compiled_schemas(click.get_app_dir('zalando-deploy-cli'))
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        return dict(executor.map(_validate_template_file, template_paths, contexts))
+
+
+def report_validation_errors(results: dict):
+    '''Print validation errors, returns True if all templates are valid'''
+    valid = True
+    for path, errors in sorted(results.items()):
+        for message in errors:
+            error('{}: {}'.format(path, message))
+            valid = False
+    return valid
+
+
+def parse_target(value: str):
+    '''Parse CLUSTER_ID:NAMESPACE (the cluster ID might contain colons itself)'''
+    cluster_id, sep, namespace = value.strip().rpartition(':')
+    if not sep or not cluster_id or not namespace:
+        raise click.BadParameter('"{}" does not match CLUSTER_ID:NAMESPACE'.format(value))
+    return cluster_id, namespace
+
+
+def get_targets(target, targets_file):
+    '''Get list of (cluster ID, namespace) tuples from --target and --targets-file options'''
+    targets = [parse_target(value) for value in target]
+    if targets_file:
+        for line in targets_file:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                targets.append(parse_target(line))
+    # remove duplicates, but keep order
+    return list(dict.fromkeys(targets))
+
+
+def targets_options(f):
+    f = click.option('--target', multiple=True, metavar='CLUSTER_ID:NAMESPACE',
+                     help='Submit to given Kubernetes cluster and namespace (can be repeated)')(f)
+    f = click.option('--targets-file', type=click.File('r'), metavar='FILE',
+                     help='Read targets (one CLUSTER_ID:NAMESPACE per line) from file')(f)
+    return f
+
+
+def target_context(context: dict, cluster_id: str, namespace: str):
+    context = dict(context)
+    context['kubernetes_cluster'] = cluster_id
+    context['kubernetes_namespace'] = namespace
+    return context
+
+
+def get_content_hash(data) -> str:
+    '''Hash of the canonical JSON representation of the given manifest'''
+    contents = json.dumps(data, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha256(contents.encode('utf-8')).hexdigest()
+
+
+def get_resource_key(config, api_path: str, data: dict) -> str:
+    key = '{}{}'.format(config.get('deploy_api') or '', api_path)
+    if 'kind' in data:
+        key += '#{}/{}'.format(data['kind'], data.get('metadata', {}).get('name'))
+    return key
+
+
+def set_content_hash_annotation(data: dict, content_hash: str):
+    annotations = data.setdefault('metadata', {}).setdefault('annotations', {})
+    annotations[LAST_APPLIED_HASH_ANNOTATION] = content_hash
+
+
+def get_live_content_hash(config, namespace: str, data: dict):
+    '''Get content hash annotation of the live Kubernetes resource (if any)'''
+    name = data.get('metadata', {}).get('name')
+    if not name:
+        return None
+    kubectl_login(config)
+    try:
+        live = kubectl_get(namespace, data['kind'].lower(), name)
+    except subprocess.CalledProcessError:
+        # resource does not exist (yet)
+        return None
+    return live.get('metadata', {}).get('annotations', {}).get(LAST_APPLIED_HASH_ANNOTATION)
+
+
+def is_unchanged(config, api_path: str, data: dict, applied_hashes: dict, namespace=None):
+    '''Check whether the manifest was already applied, i.e. has the same content hash
+
+    Falls back to the annotation of the live Kubernetes resource if no local state exists.'''
+    key = get_resource_key(config, api_path, data)
+    content_hash = get_content_hash(data)
+    last_hash = applied_hashes.get(key)
+    if last_hash is None and namespace:
+        last_hash = get_live_content_hash(config, namespace, data)
+        if last_hash == content_hash:
+            applied_hashes[key] = content_hash
+    return last_hash == content_hash
+
+
+def get_applied_hashes_path():
+    return os.path.join(click.get_app_dir('zalando-deploy-cli'), 'applied-hashes.json')
+
+
+def load_applied_hashes(path: str) -> dict:
+    try:
+        with open(path) as fd:
+            return json.load(fd)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def store_applied_hashes(path: str, hashes: dict):
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(path, 'w') as fd:
+        json.dump(hashes, fd, indent=2, sort_keys=True)
+
+
+def submit_to_targets(config, targets, render, execute, wait, name, applied_hashes=None):
+    '''Render and submit a Kubernetes manifest to all targets concurrently
+
+    render(cluster_id, namespace) must return the manifest for the given target.
+    Manifests with the same content hash as in applied_hashes (if given) are skipped.
+    Returns one report row per target.'''
+    def submit(target):
+        cluster_id, namespace = target
+        row = {'name': name, 'cluster': cluster_id, 'namespace': namespace, 'change_request_id': None}
+        path = '/kubernetes-clusters/{}/namespaces/{}/resources'.format(cluster_id, namespace)
+        data = render(cluster_id, namespace)
+        if applied_hashes is not None:
+            key = get_resource_key(config, path, data)
+            content_hash = get_content_hash(data)
+            if applied_hashes.get(key) == content_hash:
+                row['status'] = 'unchanged'
+                return row
+            set_content_hash_annotation(data, content_hash)
+        response = request(config, requests.post, path, exit_on_error=False, json=data)
+        if not (200 <= response.status_code < 400):
+            row['status'] = 'HTTP error {}'.format(response.status_code)
+            return row
+        row['change_request_id'] = response.json()['id']
+        row['status'] = 'submitted'
+        if execute:
+            try:
+                approve_and_execute(config, row['change_request_id'], wait)
+            except SystemExit:
+                row['status'] = 'failed'
+            else:
+                row['status'] = 'executed'
+                if applied_hashes is not None:
+                    applied_hashes[key] = content_hash
+        return row
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(len(targets), 16)) as executor:
+        return list(executor.map(submit, targets))
+
+
+def print_target_report(rows, exit_on_error=True):
+    print_rows('name cluster namespace change_request_id status'.split(), rows)
+    if exit_on_error and any(row['status'] not in ('submitted', 'executed', 'unchanged') for row in rows):
+        exit(1)
+
+
 class ResourcesUpdate:
     def __init__(self, updates=None):
         self.resources_update = updates or []
@@ -126,6 +493,13 @@ class ResourcesUpdate:
             'operations': [{'op': 'replace', 'path': '/spec/replicas', 'value': replicas}]
         })
 
+    def set_min_replicas(self, name: str, replicas: int, kind: str='horizontalpodautoscalers'):
+        self.resources_update.append({
+            'name': name,
+            'kind': kind,
+            'operations': [{'op': 'replace', 'path': '/spec/minReplicas', 'value': replicas}]
+        })
+
     def set_label(self, name: str, label_key: str, label_value: str, kind: str='deployments'):
         path = '/spec/template/metadata/labels/{}'.format(label_key)
         self.resources_update.append({
@@ -138,15 +512,43 @@ class ResourcesUpdate:
         return {'resources_update': self.resources_update}
 
 
+@metrics.timed('kubectl_login')
 def kubectl_login(config):
     arg = config.get('kubernetes_api_server')
     if not arg:
         # this requires zkubectl to be configured appropriately
         # with the Cluster Registry URL
         arg = config.get('kubernetes_cluster')
+    key = get_kubectl_login_key(arg)
+    last_key, last_login = _kubectl_login
+    if key == last_key and time.time() - last_login < KUBECTL_LOGIN_TTL:
+        # already logged in by this (agent) process and the kubeconfig was not switched since
+        return
     subprocess.check_call(['zkubectl', 'login', arg])
+    _set_kubectl_login(get_kubectl_login_key(arg))
+
+
+def _set_kubectl_login(key):
+    global _kubectl_login
+    _kubectl_login = (key, time.time())
+
+
+def get_kubectl_login_key(cluster: str):
+    '''Identify the current kubeconfig state for the given cluster
 
+    "zkubectl login" switches the context of the (shared) kubeconfig, i.e. a login of any other
+    process or for any other cluster changes the kubeconfig's modification time.'''
+    kubeconfig = os.environ.get('KUBECONFIG') or os.path.expanduser('~/.kube/config')
+    mtimes = []
+    for path in kubeconfig.split(os.pathsep):
+        try:
+            mtimes.append(os.stat(path).st_mtime_ns)
+        except OSError:
+            mtimes.append(None)
+    return cluster, kubeconfig, tuple(mtimes)
 
+
+@metrics.timed('kubectl_get', lambda namespace, kind='', *args: {'kind': kind})
 def kubectl_get(namespace, *args):
     cmd = ['zkubectl', 'get', '--namespace={}'.format(namespace), '-o', 'json'] + list(args)
     out = subprocess.check_output(cmd)
@@ -154,10 +556,91 @@ def kubectl_get(namespace, *args):
     return data
 
 
+def kubectl_get_columns(namespace, columns, *args):
+    '''Stream only the given fields of Kubernetes resources, yielding one tuple per resource
+
+    Columns are (NAME, JSONPATH) pairs, e.g. ('PHASE', '.status.phase').
+    Missing values are returned as "<none>".'''
+    spec = ','.join('{}:{}'.format(name, path) for name, path in columns)
+    cmd = ['zkubectl', 'get', '--namespace={}'.format(namespace), '--no-headers',
+           '-o', 'custom-columns={}'.format(spec)] + list(args)
+    with subprocess.Popen(cmd, stdout=subprocess.PIPE) as proc:
+        for line in proc.stdout:
+            fields = line.decode('utf-8').split()
+            if fields:
+                yield tuple(fields)
+    if proc.returncode:
+        raise subprocess.CalledProcessError(proc.returncode, cmd)
+
+
+POD_READINESS_COLUMNS = [('PHASE', '.status.phase'), ('READY', '.status.containerStatuses[*].ready')]
+
+
+def count_ready_pods(rows):
+    '''Count (ready, total) pods from (phase, container readiness) rows'''
+    pods_ready = 0
+    pods_total = 0
+    for phase, containers_ready in rows:
+        pods_total += 1
+        if phase == 'Running' and all(ready != 'false' for ready in containers_ready.split(',')):
+            pods_ready += 1
+    return pods_ready, pods_total
+
+
+def get_output_format():
+    return click.get_current_context().find_root().params.get('output') or 'text'
+
+
+def stream_response(response):
+    '''Write the raw response body to stdout chunk by chunk'''
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    for chunk in response.iter_content(chunk_size=65536):
+        sys.stdout.write(decoder.decode(chunk))
+    sys.stdout.write(decoder.decode(b'', final=True))
+
+
+def print_items(cols, response):
+    '''Print "items" of the given API response according to the selected output format'''
+    output = get_output_format()
+    if output == 'json':
+        stream_response(response)
+        print()
+    elif output == 'ndjson':
+        for item in response.json()['items']:
+            print(json.dumps(item, separators=(',', ':')))
+    else:
+        print_table(cols, response.json()['items'])
+
+
+def print_rows(cols, rows):
+    '''Print table rows according to the selected output format (clickclick handles "json")'''
+    if get_output_format() == 'ndjson':
+        for row in rows:
+            print(json.dumps(row, separators=(',', ':')))
+    else:
+        print_table(cols, rows)
+
+
 @click.group(cls=AliasedGroup, context_settings=CONTEXT_SETTINGS)
+@click.option('-o', '--output', type=click.Choice(['text', 'json', 'ndjson']), default='text',
+              help='Output format (default: text)')
 @click.pass_context
-def cli(ctx):
+def cli(ctx, output):
     ctx.obj = stups_cli.config.load_config('zalando-deploy-cli')
+    ctx.with_resource(OutputFormat(output))
+    if ctx.obj.get('metrics'):
+        metrics.enable()
+        # close callbacks run in reverse order, i.e. the command's duration is recorded before flushing
+        ctx.call_on_close(lambda: flush_metrics(ctx.obj))
+        ctx.with_resource(metrics.timer('command', command=ctx.invoked_subcommand))
+
+
+def flush_metrics(config: dict):
+    try:
+        metrics.flush(click.get_app_dir('zalando-deploy-cli'), config.get('metrics_textfile'))
+    except OSError as e:
+        # metrics must never break a deployment
+        warning('Could not store metrics: {}'.format(e))
 
 
 @cli.command()
@@ -168,6 +651,13 @@ def cli(ctx):
 @click.option('--kubernetes-cluster')
 @click.option('--kubernetes-namespace')
 @click.option('--user', help='Username to use for approvals (optional)')
+@click.option('--compress-requests/--no-compress-requests', default=None,
+              help='Send large request bodies gzip compressed (deploy API must support it)')
+@click.option('--compression-threshold', type=int, metavar='BYTES',
+              help='Minimum request body size to compress (default: {})'.format(DEFAULT_COMPRESSION_THRESHOLD))
+@click.option('--metrics/--no-metrics', default=None, help='Record durations of operations and commands locally')
+@click.option('--metrics-textfile', metavar='PATH',
+              help='Export recorded metrics as Prometheus textfile (e.g. for the node-exporter textfile collector)')
 @click.pass_obj
 def configure(config, **kwargs):
     for key, val in kwargs.items():
@@ -181,50 +671,179 @@ def configure(config, **kwargs):
 @click.argument('parameter', nargs=-1)
 @click.pass_obj
 @click.option('--execute', is_flag=True)
-def apply(config, template_or_directory, parameter, execute):
+@wait_option
+@targets_options
+@click.option('--skip-unchanged', is_flag=True,
+              help='Do not submit manifests which did not change since they were last applied')
+@click.option('--state-file', metavar='FILE',
+              help='File with content hashes of applied manifests (for --skip-unchanged)')
+@click.option('--watch', is_flag=True, help='Watch templates and re-apply them on changes')
+@click.option('--validate', is_flag=True, help='Validate all manifests locally before submitting any')
+def apply(config, template_or_directory, parameter, execute, wait, target, targets_file, skip_unchanged,
+          state_file, watch, validate):
     '''Apply CloudFormation or Kubernetes resource'''
-
+    targets = get_targets(target, targets_file)
+    context = parse_parameters(parameter)
+    report = []
+    state_file = state_file or get_applied_hashes_path()
+    applied_hashes = load_applied_hashes(state_file) if skip_unchanged else None
+    template_paths = get_template_paths(template_or_directory)
+    if validate and not report_validation_errors(validate_templates(template_paths, context)):
+        raise click.Abort()
+    try:
+        _apply(config, template_paths, context, execute, wait, targets, applied_hashes, report)
+        if watch:
+            if report:
+                print_target_report(report, exit_on_error=False)
+                report = []
+            watch_and_apply(config, template_or_directory, context, execute, wait, targets, applied_hashes)
+    finally:
+        if skip_unchanged:
+            store_applied_hashes(state_file, applied_hashes)
+
+    if report:
+        print_target_report(report)
+
+
+def get_template_paths(template_or_directory):
     template_paths = []
     if os.path.isdir(template_or_directory):
-        for entry in os.listdir(template_or_directory):
+        for entry in sorted(os.listdir(template_or_directory)):
             if entry.endswith('.yaml') and not entry.startswith('.'):
                 template_paths.append(os.path.join(template_or_directory, entry))
     else:
         template_paths.append(template_or_directory)
+    return template_paths
 
+
+def get_modification_times(template_or_directory):
+    mtimes = {}
+    for path in get_template_paths(template_or_directory):
+        try:
+            mtimes[path] = os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            pass
+    return mtimes
+
+
+def watch_templates(template_or_directory, callback, interval=WATCH_INTERVAL, debounce=WATCH_DEBOUNCE):
+    '''Call callback(paths) with all modified or new templates once a burst of modifications settled'''
+    mtimes = get_modification_times(template_or_directory)
+    while True:
+        time.sleep(interval)
+        current = get_modification_times(template_or_directory)
+        if current == mtimes:
+            continue
+        while True:
+            time.sleep(debounce)
+            settled = get_modification_times(template_or_directory)
+            if settled == current:
+                break
+            current = settled
+        changed = [path for path, mtime in sorted(current.items()) if mtimes.get(path) != mtime]
+        mtimes = current
+        if changed:
+            callback(changed)
+
+
+def watch_and_apply(config, template_or_directory, context, execute, wait, targets, applied_hashes):
+    '''Re-apply templates whose rendered contents changed until interrupted'''
+    rendered_hashes = {}
+    for path in get_template_paths(template_or_directory):
+        with open(path, 'r') as fd:
+            rendered_hashes[path] = get_content_hash(_render_template(fd, context))
+
+    def apply_changed(paths):
+        changed = []
+        for path in paths:
+            try:
+                with open(path, 'r') as fd:
+                    content_hash = get_content_hash(_render_template(fd, context))
+            except (OSError, yaml.YAMLError) as e:
+                error('Failed to render {}: {}'.format(path, e))
+                continue
+            if rendered_hashes.get(path) != content_hash:
+                rendered_hashes[path] = content_hash
+                changed.append(path)
+        if not changed:
+            return
+        report = []
+        try:
+            _apply(config, changed, context, execute, wait, targets, applied_hashes, report)
+            if report:
+                print_target_report(report, exit_on_error=False)
+        except (click.Abort, SystemExit):
+            # keep watching, the error was already reported
+            pass
+        info('Watching {} for changes..'.format(template_or_directory))
+
+    info('Watching {} for changes..'.format(template_or_directory))
+    try:
+        watch_templates(template_or_directory, apply_changed)
+    except KeyboardInterrupt:
+        pass
+
+
+def get_manifest_endpoint(config, data: dict):
+    '''Get deploy API method and path to submit the given Kubernetes manifest or Cloud Formation template'''
+    if 'kind' in data:
+        cluster_id = config.get('kubernetes_cluster')
+        namespace = config.get('kubernetes_namespace')
+        path = '/kubernetes-clusters/{}/namespaces/{}/resources'.format(cluster_id, namespace)
+        return requests.post, path
+    aws_account = config.get('aws_account')
+    aws_region = config.get('aws_region')
+    stack_name = data.get('Metadata', {}).get('StackName')
+    if not stack_name:
+        error('Cloud Formation template requires Metadata/StackName property')
+        raise click.Abort()
+    path = '/aws-accounts/{}/regions/{}/cloudformation-stacks/{}'.format(aws_account, aws_region, stack_name)
+    return requests.put, path
+
+
+def _apply(config, template_paths, context, execute, wait, targets, applied_hashes, report):
     for path in template_paths:
         with open(path, 'r') as fd:
-            data = _render_template(fd, parse_parameters(parameter))
+            parsed_template = pystache.parse(fd.read())
+        data = _render_parsed_template(parsed_template, context)
 
         if not isinstance(data, dict):
             error('Invalid YAML contents in {}'.format(path))
             raise click.Abort()
 
-        if 'kind' in data:
-            info('Applying Kubernetes manifest {}..'.format(path))
-            cluster_id = config.get('kubernetes_cluster')
-            namespace = config.get('kubernetes_namespace')
-            path = '/kubernetes-clusters/{}/namespaces/{}/resources'.format(cluster_id, namespace)
-            response = request(config, requests.post, path, json=data)
-            change_request_id = response.json()['id']
-        elif 'Resources' in data:
-            info('Applying Cloud Formation template {}..'.format(path))
-            aws_account = config.get('aws_account')
-            aws_region = config.get('aws_region')
-            stack_name = data.get('Metadata', {}).get('StackName')
-            if not stack_name:
-                error('Cloud Formation template requires Metadata/StackName property')
-                raise click.Abort()
-            path = '/aws-accounts/{}/regions/{}/cloudformation-stacks/{}'.format(
-                aws_account, aws_region, stack_name)
-            response = request(config, requests.put, path, json=data)
-            change_request_id = response.json()['id']
+        if 'kind' in data and targets:
+            info('Applying Kubernetes manifest {} to {} targets..'.format(path, len(targets)))
+            report.extend(submit_to_targets(
+                config, targets,
+                lambda cluster_id, namespace: _render_parsed_template(
+                    parsed_template, target_context(context, cluster_id, namespace)),
+                execute, wait, path, applied_hashes))
+            continue
+        elif 'kind' in data or 'Resources' in data:
+            method, api_path = get_manifest_endpoint(config, data)
+            description = 'Kubernetes manifest' if 'kind' in data else 'Cloud Formation template'
+            namespace = config.get('kubernetes_namespace') if 'kind' in data else None
+            if applied_hashes is not None and is_unchanged(config, api_path, data, applied_hashes, namespace):
+                info('Skipping unchanged {} {}..'.format(description, path))
+                continue
+            info('Applying {} {}..'.format(description, path))
         else:
             error('Neither a Kubernetes manifest nor a Cloud Formation template: {}'.format(path))
             raise click.Abort()
 
+        if applied_hashes is not None:
+            key = get_resource_key(config, api_path, data)
+            content_hash = get_content_hash(data)
+            if 'kind' in data:
+                set_content_hash_annotation(data, content_hash)
+
+        response = request(config, method, api_path, json=data)
+        change_request_id = response.json()['id']
+
         if execute:
-            approve_and_execute(config, change_request_id)
+            approve_and_execute(config, change_request_id, wait)
+            if applied_hashes is not None:
+                applied_hashes[key] = content_hash
         else:
             print(change_request_id)
 
@@ -248,12 +867,15 @@ def resolve_version(config, template, application, version, release, parameter):
     context['version'] = version
     context['release'] = release
     data = _render_template(template, context)
+    print(resolve_latest_version(data))
+
+
+def resolve_latest_version(data: dict):
+    '''Resolve "latest" version from the first container image with "latest" tag in the deployment manifest'''
     for container in data['spec']['template']['spec']['containers']:
         image = container['image']
         if image.endswith(':latest'):
-            latest_version = find_latest_docker_image_version(image)
-            print(latest_version)
-            return
+            return find_latest_docker_image_version(image)
     error('Could not resolve "latest" version: No matching container found. Please choose a version != "latest".')
     exit(2)
 
@@ -266,12 +888,32 @@ def resolve_version(config, template, application, version, release, parameter):
 @click.argument('parameter', nargs=-1)
 @click.pass_obj
 @click.option('--execute', is_flag=True)
-def create_deployment(config, template, application, version, release, parameter, execute):
+@wait_option
+@targets_options
+@click.option('--validate', is_flag=True, help='Validate manifest locally before submitting it')
+def create_deployment(config, template, application, version, release, parameter, execute, wait, target, targets_file,
+                      validate):
     '''Create a new Kubernetes deployment'''
     context = parse_parameters(parameter)
     context['application'] = application
     context['version'] = version
     context['release'] = release
+    if validate:
+        contents = template.read()
+        errors = validation.validate_manifest(_render_template(io.StringIO(contents), context),
+                                              click.get_app_dir('zalando-deploy-cli'))
+        if not report_validation_errors({template.name: errors}):
+            raise click.Abort()
+        template = io.StringIO(contents)
+    targets = get_targets(target, targets_file)
+    if targets:
+        parsed_template = pystache.parse(template.read())
+        print_target_report(submit_to_targets(
+            config, targets,
+            lambda cluster_id, namespace: _render_parsed_template(
+                parsed_template, target_context(context, cluster_id, namespace)),
+            execute, wait, '{}-{}-{}'.format(application, version, release)))
+        return
     data = _render_template(template, context)
 
     cluster_id = config.get('kubernetes_cluster')
@@ -281,7 +923,7 @@ def create_deployment(config, template, application, version, release, parameter
     change_request_id = response.json()['id']
 
     if execute:
-        approve_and_execute(config, change_request_id)
+        approve_and_execute(config, change_request_id, wait)
     else:
         print(change_request_id)
 
@@ -298,32 +940,61 @@ def create_deployment(config, template, application, version, release, parameter
 @click.option('-i', '--interval', default=10,
               type=click.IntRange(1, 600, clamp=True),
               help='Time between checks (default: 10s)')
+@click.option('--report', is_flag=True,
+              help='Print rollout latency report (time to pod scheduled, container start and ready)')
 @click.pass_obj
-def wait_for_deployment(config, application, version, release, timeout, interval):
+def wait_for_deployment(config, application, version, release, timeout, interval, report):
     '''Wait for all pods to become ready'''
     namespace = config.get('kubernetes_namespace')
     kubectl_login(config)
+    ready = wait_for_pods_ready(namespace, application, version, release, timeout, interval)
+    if report:
+        # also useful on timeout to see which phase is slow
+        pods = kubectl_get(namespace, 'pods', '-l',
+                           'application={},version={},release={}'.format(application, version, release))
+        print_rollout_report(rollout.get_report(pods['items']))
+    if not ready:
+        raise click.Abort()
+
+
+def format_seconds(value):
+    return '-' if value is None else '{:.0f}s'.format(value)
+
+
+def print_rollout_report(report: dict):
+    output = get_output_format()
+    if output == 'json':
+        print(json.dumps(report))
+    elif output == 'ndjson':
+        for row in report['pods']:
+            print(json.dumps(row, separators=(',', ':')))
+    else:
+        def formatted(rows):
+            return [{key: format_seconds(val) if key in ('p50', 'p95', 'max') + rollout.PHASES else val
+                     for key, val in row.items()} for row in rows]
+        print_table('phase pods p50 p95 max'.split(), formatted(report['summary']))
+        if report['slowest_pods']:
+            info('Slowest pods:')
+            print_table('pod scheduled started ready'.split(), formatted(report['slowest_pods']))
+        if report['slowest_containers']:
+            info('Slowest containers:')
+            print_table('pod container started'.split(), formatted(report['slowest_containers']))
+
+
+def wait_for_pods_ready(namespace, application, version, release, timeout, interval, min_ready=1):
+    '''Wait until all (and at least min_ready) pods of the deployment are ready, returns False on timeout'''
     deployment_name = '{}-{}-{}'.format(application, version, release)
     cutoff = time.time() + timeout
     while time.time() < cutoff:
-        data = kubectl_get(namespace, 'pods', '-l',
-                           'application={},version={},release={}'.format(application, version, release))
-        pods = data['items']
-        pods_ready = 0
-        for pod in pods:
-            if pod['status'].get('phase') == 'Running':
-                all_containers_ready = True
-                for cont in pod['status'].get('containerStatuses', []):
-                    if not cont.get('ready'):
-                        all_containers_ready = False
-                if all_containers_ready:
-                    pods_ready += 1
-        if pods and pods_ready >= len(pods):
-            return
+        rows = kubectl_get_columns(namespace, POD_READINESS_COLUMNS, 'pods', '-l',
+                                   'application={},version={},release={}'.format(application, version, release))
+        pods_ready, pods_total = count_ready_pods(rows)
+        if pods_total and pods_ready >= max(pods_total, min_ready):
+            return True
         info('Waiting up to {:.0f} more secs for deployment '
-             '{} ({}/{} pods ready)..'.format(cutoff - time.time(), deployment_name, pods_ready, len(pods)))
+             '{} ({}/{} pods ready)..'.format(cutoff - time.time(), deployment_name, pods_ready, pods_total))
         time.sleep(interval)
-    raise click.Abort()
+    return False
 
 
 @cli.command('promote-deployment')
@@ -332,8 +1003,9 @@ def wait_for_deployment(config, application, version, release, timeout, interval
 @release_argument
 @click.argument('stage')
 @click.option('--execute', is_flag=True)
+@wait_option
 @click.pass_obj
-def promote_deployment(config, application, version, release, stage, execute):
+def promote_deployment(config, application, version, release, stage, execute, wait):
     '''Promote deployment to new stage'''
     namespace = config.get('kubernetes_namespace')
     deployment_name = '{}-{}-{}'.format(application, version, release)
@@ -349,7 +1021,7 @@ def promote_deployment(config, application, version, release, stage, execute):
     change_request_id = response.json()['id']
 
     if execute:
-        approve_and_execute(config, change_request_id)
+        approve_and_execute(config, change_request_id, wait)
     else:
         print(change_request_id)
 
@@ -361,8 +1033,20 @@ def promote_deployment(config, application, version, release, stage, execute):
 @click.argument('ratio')
 @click.pass_obj
 @click.option('--execute', is_flag=True)
-def switch_deployment(config, application, version, release, ratio, execute):
+@wait_option
+@click.option('--scale-down-after-ready', is_flag=True,
+              help='Scale down other deployments only after the scaled up pods are ready (requires --execute)')
+@click.option('--min-ready-capacity', type=click.IntRange(0), metavar='PODS',
+              help='Do not scale down if less ready pods would remain (with --scale-down-after-ready)')
+@click.option('-t', '--timeout', type=click.IntRange(0, 7200, clamp=True), metavar='SECS', default=300,
+              help='Maximum wait time for pods to become ready (default: 300s)')
+def switch_deployment(config, application, version, release, ratio, execute, wait, scale_down_after_ready,
+                      min_ready_capacity, timeout):
     '''Switch to new release'''
+    if scale_down_after_ready and not execute:
+        raise click.UsageError('--scale-down-after-ready requires --execute')
+    if min_ready_capacity is not None and not scale_down_after_ready:
+        raise click.UsageError('--min-ready-capacity requires --scale-down-after-ready')
     namespace = config.get('kubernetes_namespace')
     kubectl_login(config)
 
@@ -382,30 +1066,87 @@ def switch_deployment(config, application, version, release, ratio, execute):
         error("Deployment {} does not exist!".format(target_deployment_name))
         exit(1)
 
-    resources_update = ResourcesUpdate()
-    remaining_replicas = total - target_replicas
-    for deployment in sorted(deployments, key=lambda d: d['metadata']['name'], reverse=True):
-        deployment_name = deployment['metadata']['name']
-        if deployment_name == target_deployment_name:
-            replicas = target_replicas
+    plan = plan_switch(deployments, target_deployment_name, target_replicas, total)
+    cluster_id = config.get('kubernetes_cluster')
+    path = '/kubernetes-clusters/{}/namespaces/{}/resources'.format(cluster_id, namespace)
+
+    if not scale_down_after_ready:
+        resources_update = ResourcesUpdate()
+        for deployment_name, replicas in plan:
+            info('Scaling deployment {} to {} replicas..'.format(deployment_name, replicas))
+            resources_update.set_number_of_replicas(deployment_name, replicas)
+        response = request(config, requests.patch, path, json=resources_update.to_dict())
+        change_request_id = response.json()['id']
+
+        if execute:
+            approve_and_execute(config, change_request_id, wait)
         else:
-            # maybe spread across all other deployments?
-            replicas = remaining_replicas
-            remaining_replicas = 0
+            print(change_request_id)
+        return
 
-        info('Scaling deployment {} to {} replicas..'.format(deployment_name, replicas))
+    current = {d['metadata']['name']: get_deployment_replicas(d) for d in deployments}
+    scale_up = [(name, replicas) for name, replicas in plan if replicas > current[name]]
+    scale_down = [(name, replicas) for name, replicas in plan if replicas < current[name]]
+
+    if scale_up:
+        resources_update = ResourcesUpdate()
+        for deployment_name, replicas in scale_up:
+            info('Scaling up deployment {} to {} replicas..'.format(deployment_name, replicas))
+            resources_update.set_number_of_replicas(deployment_name, replicas)
+        response = request(config, requests.patch, path, json=resources_update.to_dict())
+        approve_and_execute(config, response.json()['id'], wait=True)
+        if target_replicas and not wait_for_pods_ready(namespace, application, version, release, timeout,
+                                                       interval=10, min_ready=target_replicas):
+            error('Pods of deployment {} did not become ready, not scaling down.'.format(target_deployment_name))
+            exit(1)
+
+    if not scale_down:
+        return
+    if min_ready_capacity is not None:
+        rows = kubectl_get_columns(namespace, POD_READINESS_COLUMNS, 'pods', '-l',
+                                   'application={}'.format(application))
+        pods_ready, _ = count_ready_pods(rows)
+        removed = sum(current[name] - replicas for name, replicas in scale_down)
+        if pods_ready - removed < min_ready_capacity:
+            error('Only {} of minimum {} pods would remain ready, not scaling down.'.format(
+                  pods_ready - removed, min_ready_capacity))
+            exit(1)
+    resources_update = ResourcesUpdate()
+    for deployment_name, replicas in scale_down:
+        info('Scaling down deployment {} to {} replicas..'.format(deployment_name, replicas))
         resources_update.set_number_of_replicas(deployment_name, replicas)
-
-    cluster_id = config.get('kubernetes_cluster')
-    namespace = config.get('kubernetes_namespace')
-    path = '/kubernetes-clusters/{}/namespaces/{}/resources'.format(cluster_id, namespace)
     response = request(config, requests.patch, path, json=resources_update.to_dict())
-    change_request_id = response.json()['id']
+    approve_and_execute(config, response.json()['id'], wait)
 
-    if execute:
-        approve_and_execute(config, change_request_id)
-    else:
-        print(change_request_id)
+
+def get_deployment_replicas(deployment: dict):
+    return deployment.get('spec', {}).get('replicas') or 0
+
+
+def plan_switch(deployments: list, target_deployment_name: str, target_replicas: int, total: int):
+    '''Plan number of replicas per deployment, returns list of (deployment name, replicas)
+
+    The remaining replicas (total - target_replicas) are spread across all other deployments
+    in proportion to their current number of replicas (largest remainder method).
+    If no other deployment has any replicas, the one with the highest name gets all.'''
+    others = sorted((d for d in deployments if d['metadata']['name'] != target_deployment_name),
+                    key=lambda d: d['metadata']['name'], reverse=True)
+    remaining_replicas = max(total - target_replicas, 0)
+    weights = [get_deployment_replicas(d) for d in others]
+    if not sum(weights):
+        weights = [1] + [0] * (len(others) - 1)
+    weight_sum = sum(weights)
+    shares = [remaining_replicas * weight / weight_sum for weight in weights]
+    replicas = [int(share) for share in shares]
+    # give the left-over replicas to the deployments with the largest remainders
+    by_remainder = sorted(range(len(others)), key=lambda i: (shares[i] - replicas[i], weights[i]), reverse=True)
+    for i in by_remainder[:remaining_replicas - sum(replicas)]:
+        replicas[i] += 1
+
+    planned = dict(zip((d['metadata']['name'] for d in others), replicas))
+    planned[target_deployment_name] = target_replicas
+    return [(d['metadata']['name'], planned[d['metadata']['name']])
+            for d in sorted(deployments, key=lambda d: d['metadata']['name'], reverse=True)]
 
 
 @cli.command('get-current-replicas')
@@ -415,10 +1156,86 @@ def get_current_replicas(config, application):
     '''Get current total number of replicas for given application'''
     namespace = config.get('kubernetes_namespace')
     data = kubectl_get(namespace, 'deployments', '-l', 'application={}'.format(application))
+    print(sum_current_replicas(data['items']))
+
+
+def sum_current_replicas(deployments: list):
     replicas = 0
-    for deployment in data['items']:
+    for deployment in deployments:
         replicas += deployment.get('status', {}).get('replicas', 0)
-    print(replicas)
+    return replicas
+
+
+def parse_cpu_quantity(quantity) -> int:
+    '''Parse Kubernetes CPU quantity (e.g. "100m" or "1.5") to millicores'''
+    quantity = str(quantity)
+    if quantity.endswith('m'):
+        return int(float(quantity[:-1]))
+    return int(float(quantity) * 1000)
+
+
+def get_pod_cpu_request(deployment: dict):
+    '''Sum of container CPU requests (millicores) of a deployment's pod template (None if not set)'''
+    total = 0
+    for container in deployment.get('spec', {}).get('template', {}).get('spec', {}).get('containers', []):
+        cpu = container.get('resources', {}).get('requests', {}).get('cpu')
+        if cpu is None:
+            return None
+        total += parse_cpu_quantity(cpu)
+    return total or None
+
+
+def kubectl_top_pods_cpu(namespace, *args):
+    '''Get total CPU usage (millicores) of pods, None if metrics are not available'''
+    cmd = ['zkubectl', 'top', 'pods', '--namespace={}'.format(namespace), '--no-headers'] + list(args)
+    try:
+        out = subprocess.check_output(cmd, stderr=subprocess.DEVNULL)
+        return sum(parse_cpu_quantity(line.split()[1]) for line in out.decode('utf-8').splitlines() if line.strip())
+    except (subprocess.CalledProcessError, OSError, IndexError, ValueError):
+        return None
+
+
+def get_warm_start_replicas(namespace: str, application: str, hpa: dict):
+    '''Get number of replicas needed to serve the current load of all deployments of the application
+
+    Uses the live CPU usage and the HPA's target CPU utilization if available,
+    the current number of replicas otherwise.'''
+    data = kubectl_get(namespace, 'deployments', '-l', 'application={}'.format(application))
+    deployments = data['items']
+    replicas = sum_current_replicas(deployments)
+    target_utilization = hpa.get('spec', {}).get('targetCPUUtilizationPercentage')
+    largest = max(deployments, key=lambda d: d.get('status', {}).get('replicas', 0), default=None)
+    cpu_request = get_pod_cpu_request(largest) if largest else None
+    if target_utilization and cpu_request:
+        cpu_usage = kubectl_top_pods_cpu(namespace, '-l', 'application={}'.format(application))
+        if cpu_usage is not None:
+            replicas = math.ceil(cpu_usage / (cpu_request * target_utilization / 100))
+    return replicas
+
+
+def step_down_min_replicas(config, hpa_name: str, start: int, end: int, window: int, steps: int):
+    '''Lower minReplicas of the HPA from start to end in equal steps spread over the time window
+
+    If interrupted, the HPA keeps the minReplicas of the last executed step: report it.'''
+    cluster_id = config.get('kubernetes_cluster')
+    namespace = config.get('kubernetes_namespace')
+    path = '/kubernetes-clusters/{}/namespaces/{}/resources'.format(cluster_id, namespace)
+    steps = max(min(steps, start - end), 1)
+    current = start
+    try:
+        for step in range(1, steps + 1):
+            time.sleep(window / steps)
+            min_replicas = start - round((start - end) * step / steps)
+            info('Setting minimum replicas of autoscaler {} to {}..'.format(hpa_name, min_replicas))
+            resources_update = ResourcesUpdate()
+            resources_update.set_min_replicas(hpa_name, min_replicas)
+            response = request(config, requests.patch, path, json=resources_update.to_dict())
+            approve_and_execute(config, response.json()['id'])
+            current = min_replicas
+    except KeyboardInterrupt:
+        error('Warm start interrupted: autoscaler {} keeps minReplicas={} instead of {}. '
+              'Apply the template again without --warm-start to restore it.'.format(hpa_name, current, end))
+        raise
 
 
 @cli.command('scale-deployment')
@@ -428,7 +1245,8 @@ def get_current_replicas(config, application):
 @click.argument('replicas', type=int)
 @click.pass_obj
 @click.option('--execute', is_flag=True)
-def scale_deployment(config, application, version, release, replicas, execute):
+@wait_option
+def scale_deployment(config, application, version, release, replicas, execute, wait):
     '''Scale a single deployment'''
     namespace = config.get('kubernetes_namespace')
     kubectl_login(config)
@@ -446,7 +1264,7 @@ def scale_deployment(config, application, version, release, replicas, execute):
     change_request_id = response.json()['id']
 
     if execute:
-        approve_and_execute(config, change_request_id)
+        approve_and_execute(config, change_request_id, wait)
     else:
         print(change_request_id)
 
@@ -459,22 +1277,61 @@ def scale_deployment(config, application, version, release, replicas, execute):
 @click.argument('parameter', nargs=-1)
 @click.pass_obj
 @click.option('--execute', is_flag=True)
-def apply_autoscaling(config, template, application, version, release, parameter, execute):
+@wait_option
+@targets_options
+@click.option('--warm-start', is_flag=True,
+              help='Start with minReplicas covering the current load of the application (requires --execute)')
+@click.option('--warm-start-window', type=click.IntRange(0, 7200), default=600, metavar='SECS',
+              help='Time to step minReplicas down to the template value, the command keeps running '
+                   'in the foreground meanwhile: if interrupted, the autoscaler keeps the raised minReplicas '
+                   '(default: 600s)')
+@click.option('--warm-start-steps', type=click.IntRange(1, 100), default=5,
+              help='Number of steps to lower minReplicas in (default: 5)')
+def apply_autoscaling(config, template, application, version, release, parameter, execute, wait, target, targets_file,
+                      warm_start, warm_start_window, warm_start_steps):
     '''Apply Horizontal Pod Autoscaling to current deployment'''
     context = parse_parameters(parameter)
     context['application'] = application
     context['version'] = version
     context['release'] = release
+    targets = get_targets(target, targets_file)
+    if warm_start and not execute:
+        # nobody would step down the raised minReplicas afterwards
+        raise click.UsageError('--warm-start requires --execute')
+    if warm_start and targets:
+        raise click.UsageError('--warm-start can not be used with multiple targets')
+    if targets:
+        parsed_template = pystache.parse(template.read())
+        print_target_report(submit_to_targets(
+            config, targets,
+            lambda cluster_id, namespace: _render_parsed_template(
+                parsed_template, target_context(context, cluster_id, namespace)),
+            execute, wait, '{}-{}-{}'.format(application, version, release)))
+        return
     data = _render_template(template, context)
 
     cluster_id = config.get('kubernetes_cluster')
     namespace = config.get('kubernetes_namespace')
+
+    spec = data.get('spec', {})
+    min_replicas = spec.get('minReplicas', 1)
+    seed_replicas = min_replicas
+    if warm_start:
+        kubectl_login(config)
+        seed_replicas = get_warm_start_replicas(namespace, application, data)
+        seed_replicas = max(min(seed_replicas, spec.get('maxReplicas', seed_replicas)), min_replicas)
+        info('Starting autoscaler with {} minimum replicas..'.format(seed_replicas))
+        spec['minReplicas'] = seed_replicas
+
     path = '/kubernetes-clusters/{}/namespaces/{}/resources'.format(cluster_id, namespace)
     response = request(config, requests.post, path, json=data)
     change_request_id = response.json()['id']
 
     if execute:
-        approve_and_execute(config, change_request_id)
+        approve_and_execute(config, change_request_id, wait)
+        if seed_replicas > min_replicas and warm_start_window:
+            step_down_min_replicas(config, data['metadata']['name'], seed_replicas, min_replicas,
+                                   warm_start_window, warm_start_steps)
     else:
         print(change_request_id)
 
@@ -484,7 +1341,8 @@ def apply_autoscaling(config, template, application, version, release, parameter
 @click.argument('resource')
 @click.pass_obj
 @click.option('--execute', is_flag=True)
-def delete(config, type, resource, execute):
+@wait_option
+def delete(config, type, resource, execute, wait):
     '''Delete a Kubernetes resource or Cloud Formation stack'''
 
     if type == 'kubernetes':
@@ -511,7 +1369,7 @@ def delete(config, type, resource, execute):
     change_request_id = response.json()['id']
 
     if execute:
-        approve_and_execute(config, change_request_id)
+        approve_and_execute(config, change_request_id, wait)
     else:
         print(change_request_id)
 
@@ -522,7 +1380,8 @@ def delete(config, type, resource, execute):
 @release_argument
 @click.pass_obj
 @click.option('--execute', is_flag=True)
-def delete_old_deployments(config, application, version, release, execute):
+@wait_option
+def delete_old_deployments(config, application, version, release, execute, wait):
     '''Delete old releases'''
     namespace = config.get('kubernetes_namespace')
     kubectl_login(config)
@@ -554,7 +1413,121 @@ def delete_old_deployments(config, application, version, release, execute):
         change_request_id = response.json()['id']
 
         if execute:
-            approve_and_execute(config, change_request_id)
+            approve_and_execute(config, change_request_id, wait)
+        else:
+            print(change_request_id)
+
+
+@cli.command('validate')
+@click.argument('template_or_directory')
+@click.argument('parameter', nargs=-1)
+@click.option('-j', '--jobs', type=click.IntRange(1, 64, clamp=True),
+              help='Number of parallel validation processes (default: number of CPUs for {} or more templates)'.format(
+                  PARALLEL_VALIDATION_MIN_TEMPLATES))
+@click.pass_obj
+def validate(config, template_or_directory, parameter, jobs):
+    '''Validate rendered Kubernetes manifests and Cloud Formation templates locally'''
+    template_paths = get_template_paths(template_or_directory)
+    results = validate_templates(template_paths, parse_parameters(parameter), jobs)
+    if not report_validation_errors(results):
+        exit(1)
+    info('{} template(s) valid.'.format(len(results)))
+
+
+def get_bundle_templates(deploy_folder: str):
+    '''Get (stage, path) tuples for all templates of the given deploy folder'''
+    templates = []
+    apply_folder = os.path.join(deploy_folder, 'apply')
+    if os.path.isdir(apply_folder):
+        templates.extend(('apply', path) for path in get_template_paths(apply_folder))
+    for stage in BUNDLE_STAGES[1:]:
+        path = os.path.join(deploy_folder, '{}.yaml'.format(stage))
+        if os.path.isfile(path):
+            templates.append((stage, path))
+    return templates
+
+
+def get_bundle_checksum(bundle: dict):
+    return get_content_hash({key: val for key, val in bundle.items() if key != 'checksum'})
+
+
+def load_bundle(fd):
+    try:
+        bundle = json.load(fd)
+    except ValueError as e:
+        error('Invalid bundle {}: {}'.format(fd.name, e))
+        raise click.Abort()
+    if bundle.get('format') != BUNDLE_FORMAT:
+        error('Unsupported bundle format {} in {}'.format(bundle.get('format'), fd.name))
+        raise click.Abort()
+    if bundle.get('checksum') != get_bundle_checksum(bundle):
+        error('Checksum mismatch for bundle {}'.format(fd.name))
+        raise click.Abort()
+    return bundle
+
+
+@cli.command('bundle')
+@click.argument('deploy_folder', type=click.Path(exists=True, file_okay=False))
+@application_argument
+@version_argument
+@release_argument
+@click.argument('parameter', nargs=-1)
+@click.option('-O', '--output-file', type=click.File('w'), default='bundle.json',
+              help='Bundle file to write (default: bundle.json)')
+@click.pass_obj
+def bundle(config, deploy_folder, application, version, release, parameter, output_file):
+    '''Render deploy folder once into a checksummed bundle for "apply-bundle"'''
+    context = parse_parameters(parameter)
+    context['application'] = application
+    context['version'] = version
+    context['release'] = release
+    templates = get_bundle_templates(deploy_folder)
+    if not templates:
+        error('No templates found in {}'.format(deploy_folder))
+        raise click.Abort()
+
+    deployment_templates = [path for stage, path in templates if stage == 'deployment']
+    if version == 'latest' and deployment_templates:
+        with open(deployment_templates[0], 'r') as fd:
+            context['version'] = resolve_latest_version(_render_template(fd, context))
+
+    manifests = []
+    for stage, path in templates:
+        with open(path, 'r') as fd:
+            data = _render_template(fd, context)
+        if not isinstance(data, dict):
+            error('Invalid YAML contents in {}'.format(path))
+            raise click.Abort()
+        manifests.append({'stage': stage, 'path': os.path.relpath(path, deploy_folder), 'manifest': data})
+
+    data = {'format': BUNDLE_FORMAT, 'application': application, 'version': context['version'],
+            'release': release, 'manifests': manifests}
+    data['checksum'] = get_bundle_checksum(data)
+    json.dump(data, output_file, separators=(',', ':'), default=str)
+    info('Wrote {} manifests to {}'.format(len(manifests), output_file.name))
+    print(context['version'])
+
+
+@cli.command('apply-bundle')
+@click.argument('bundle_file', type=click.File('r'))
+@click.option('--stage', type=click.Choice(BUNDLE_STAGES), multiple=True,
+              help='Only submit manifests of the given stage (can be repeated, default: all stages)')
+@click.pass_obj
+@click.option('--execute', is_flag=True)
+@wait_option
+def apply_bundle(config, bundle_file, stage, execute, wait):
+    '''Submit pre-rendered manifests from bundle'''
+    data = load_bundle(bundle_file)
+    for entry in data['manifests']:
+        if stage and entry['stage'] not in stage:
+            continue
+        method, path = get_manifest_endpoint(config, entry['manifest'])
+        info('Applying {} {} from bundle..'.format(entry['stage'], entry['path']))
+        response = request(config, method, path, json=entry['manifest'])
+        change_request_id = response.json()['id']
+
+        if execute:
+            approve_and_execute(config, change_request_id, wait)
         else:
             print(change_request_id)
 
@@ -573,28 +1546,35 @@ def render_template(config, template, parameter):
 @click.pass_obj
 def list_change_requests(config):
     '''List change requests'''
-    response = request(config, requests.get, '/change-requests')
-    items = response.json()['items']
-    rows = []
-    for row in items:
-        rows.append(row)
-    print_table('id platform kind user executed'.split(), rows)
+    response = request(config, requests.get, '/change-requests', stream=True)
+    print_items('id platform kind user executed'.split(), response)
 
 
 @cli.command('get-change-request')
-@click.argument('change_request_id', nargs=-1)
+@click.argument('change_request_id', nargs=-1, shell_complete=complete_change_request_id)
 @click.pass_obj
 def get_change_request(config, change_request_id):
     '''Get one or more change requests'''
-    for id_ in change_request_id:
+    output = get_output_format()
+    if output == 'json':
+        sys.stdout.write('[')
+    for i, id_ in enumerate(change_request_id):
         path = '/change-requests/{}'.format(id_)
-        response = request(config, requests.get, path)
-        data = response.json()
-        print(yaml.safe_dump(data, default_flow_style=False))
+        response = request(config, requests.get, path, stream=True)
+        if output == 'json':
+            if i:
+                sys.stdout.write(',')
+            stream_response(response)
+        elif output == 'ndjson':
+            print(json.dumps(response.json(), separators=(',', ':')))
+        else:
+            print(yaml.safe_dump(response.json(), default_flow_style=False))
+    if output == 'json':
+        print(']')
 
 
 @cli.command('approve-change-request')
-@click.argument('change_request_id', nargs=-1)
+@click.argument('change_request_id', nargs=-1, shell_complete=complete_change_request_id)
 @click.pass_obj
 def approve_change_request(config, change_request_id):
     '''Approve one or more change requests'''
@@ -603,59 +1583,267 @@ def approve_change_request(config, change_request_id):
 
 
 @cli.command('list-approvals')
-@click.argument('change_request_id')
+@click.argument('change_request_id', shell_complete=complete_change_request_id)
 @click.pass_obj
 def list_approvals(config, change_request_id):
     '''Show approvals for given change request'''
     path = '/change-requests/{}/approvals'.format(change_request_id)
-    response = request(config, requests.get, path)
-    items = response.json()['items']
-    rows = []
-    for row in items:
-        rows.append(row)
-    print_table('user created_at'.split(), rows)
+    response = request(config, requests.get, path, stream=True)
+    print_items('user created_at'.split(), response)
 
 
 @cli.command('execute-change-request')
-@click.argument('change_request_id', nargs=-1)
+@click.argument('change_request_id', nargs=-1, shell_complete=complete_change_request_id)
+@wait_option
 @click.pass_obj
-def execute_change_request(config, change_request_id):
+def execute_change_request(config, change_request_id, wait):
     '''Execute one or more change requests'''
     for id_ in change_request_id:
         execute(config, id_)
+    if wait and change_request_id:
+        states = wait_for_change_requests(config, change_request_id)
+        report_change_request_timeouts(states)
+        if set(states.values()) != {'executed'}:
+            exit(1)
+
+
+def encrypt_secret(config, plain_text):
+    response = request(config, requests.post, '/secrets', json={'plaintext': plain_text})
+    return 'deployment-secret:{}'.format(response.json()['data'])
+
+
+def parse_batch_secrets(lines):
+    '''Parse KEY=VALUE or JSON lines ({"name": .., "value": ..} or {KEY: VALUE}) into (key, value) pairs'''
+    secrets = []
+    for lineno, line in enumerate(lines, 1):
+        line = line.rstrip('\n')
+        if not line.strip() or line.lstrip().startswith('#'):
+            continue
+        if line.lstrip().startswith('{'):
+            try:
+                entry = json.loads(line)
+            except ValueError as e:
+                raise click.UsageError('Invalid JSON in line {}: {}'.format(lineno, e))
+            if 'name' in entry and 'value' in entry:
+                secrets.append((str(entry['name']), str(entry['value'])))
+            else:
+                secrets.extend((str(key), str(val)) for key, val in entry.items())
+        elif '=' in line:
+            key, val = line.split('=', 1)
+            secrets.append((key.strip(), val))
+        else:
+            raise click.UsageError('Line {} is neither KEY=VALUE nor JSON'.format(lineno))
+    return secrets
+
+
+@cli.command('wait-for-change-request')
+@click.argument('change_request_id', nargs=-1, required=True, shell_complete=complete_change_request_id)
+@click.option('-t', '--timeout',
+              type=click.IntRange(0, 7200, clamp=True),
+              metavar='SECS',
+              default=600,
+              help='Maximum wait time (default: 600s)')
+@click.option('-i', '--interval', default=30,
+              type=click.IntRange(1, 600, clamp=True),
+              help='Maximum time between checks (default: 30s)')
+@click.pass_obj
+def wait_for_change_request(config, change_request_id, timeout, interval):
+    '''Wait for one or more change requests to be executed'''
+    states = wait_for_change_requests(config, change_request_id, timeout=timeout,
+                                      interval=min(2, interval), max_interval=interval)
+    if None in states.values():
+        report_change_request_timeouts(states)
+        raise click.Abort()
+    if 'failed' in states.values():
+        exit(1)
+
+
+def is_stack_event(stack_name: str, event: dict):
+    return event.get('ResourceType') == 'AWS::CloudFormation::Stack' and event.get('LogicalResourceId') == stack_name
+
+
+def is_final_stack_event(stack_name: str, event: dict):
+    final = event.get('ResourceStatus') in STACK_COMPLETE_STATES | STACK_FAILED_STATES
+    return final and is_stack_event(stack_name, event)
+
+
+def get_event_time(event: dict):
+    '''Parse UTC timestamp of a stack event into seconds since epoch (None if missing or invalid)'''
+    match = STACK_EVENT_TIMESTAMP_PATTERN.match(str(event.get('Timestamp') or ''))
+    if not match:
+        return None
+    return calendar.timegm(time.strptime(match.group(1), '%Y-%m-%dT%H:%M:%S'))
+
+
+def get_new_stack_events(stack_name: str, events: list, last_event_id):
+    '''Return events (newest first) after last_event_id in chronological order
+
+    Without last_event_id only the events of the latest stack operation are returned.'''
+    new_events = []
+    for event in events:
+        if event['EventId'] == last_event_id:
+            break
+        if last_event_id is None and new_events and is_final_stack_event(stack_name, event):
+            # end of previous stack operation
+            break
+        new_events.append(event)
+    return new_events[::-1]
+
+
+def get_stack_state(stack_name: str, events: list):
+    '''Return "complete", "failed" or None (still in progress) from the given events in chronological order'''
+    for event in reversed(events):
+        if is_stack_event(stack_name, event):
+            status = event.get('ResourceStatus')
+            if status in STACK_COMPLETE_STATES:
+                return 'complete'
+            if status in STACK_FAILED_STATES:
+                return 'failed'
+            return None
+    return None
+
+
+def print_stack_event(stack_name: str, event: dict):
+    if get_output_format() == 'ndjson':
+        print(json.dumps(dict(event, StackName=stack_name), separators=(',', ':')))
+    else:
+        info('{} {} {} {} {} {}'.format(stack_name, event.get('Timestamp', ''), event.get('LogicalResourceId', ''),
+                                        event.get('ResourceType', ''), event.get('ResourceStatus', ''),
+                                        event.get('ResourceStatusReason') or '').rstrip())
+
+
+def wait_for_stacks(config, stack_names, timeout=1800, interval=2, max_interval=30,
+                    max_age=DEFAULT_STACK_EVENT_MAX_AGE):
+    '''Follow events of all given Cloud Formation stacks until they reached a final state
+
+    Only new events are fetched (and printed) on every poll. The poll interval grows by 50%
+    for every poll without any new event. A stack operation which finished more than max_age
+    seconds before waiting started is considered stale, i.e. the next operation is waited for.
+    Returns a dict mapping each stack name to its final state (or None on timeout).'''
+    started = time.time()
+    states = dict.fromkeys(stack_names)
+    last_event_ids = dict.fromkeys(stack_names)
+    path = '/aws-accounts/{}/regions/{}/cloudformation-stacks/{{}}/events'.format(
+        config.get('aws_account'), config.get('aws_region'))
+    min_interval = interval
+
+    def poll(stack_name):
+        last_event_id = last_event_ids[stack_name]
+        params = {'after': last_event_id} if last_event_id else {}
+        response = request(config, requests.get, path.format(stack_name), params=params)
+        events = response.json()['items']
+        if last_event_id is None and events and is_final_stack_event(stack_name, events[0]):
+            finished = get_event_time(events[0])
+            if finished is not None and finished >= started - max_age:
+                # operation finished recently, e.g. before the first poll or without any updates to perform
+                return stack_name, get_new_stack_events(stack_name, events, last_event_id)
+            # latest stack operation finished long before we started waiting (e.g. the new one did not
+            # start yet): do not report its stale result, but wait for the next operation
+            info('Waiting for new operation of stack {} (last one ended with {})..'.format(
+                stack_name, events[0].get('ResourceStatus')))
+            last_event_ids[stack_name] = events[0]['EventId']
+            return stack_name, []
+        return stack_name, get_new_stack_events(stack_name, events, last_event_id)
+
+    cutoff = time.time() + timeout
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(len(states), 16) or 1) as executor:
+        while True:
+            pending = [name for name, state in states.items() if state is None]
+            changed = False
+            for stack_name, events in executor.map(poll, pending):
+                for event in events:
+                    print_stack_event(stack_name, event)
+                if events:
+                    last_event_ids[stack_name] = events[-1]['EventId']
+                    states[stack_name] = get_stack_state(stack_name, events)
+                    changed = True
+                    if states[stack_name]:
+                        info('Stack {} {}.'.format(stack_name, states[stack_name]))
+            pending = [name for name, state in states.items() if state is None]
+            if not pending or time.time() >= cutoff:
+                break
+            interval = min_interval if changed else min(interval * 1.5, max_interval)
+            time.sleep(min(interval, max(cutoff - time.time(), 0)))
+    return states
+
+
+@cli.command('wait-for-stack')
+@click.argument('stack_name', nargs=-1, required=True)
+@click.option('-t', '--timeout',
+              type=click.IntRange(0, 7200, clamp=True),
+              metavar='SECS',
+              default=1800,
+              help='Maximum wait time (default: 1800s)')
+@click.option('-i', '--interval', default=30,
+              type=click.IntRange(1, 600, clamp=True),
+              help='Maximum time between checks (default: 30s)')
+@click.option('--max-age', type=click.IntRange(0, None), metavar='SECS', default=DEFAULT_STACK_EVENT_MAX_AGE,
+              help='Report stack operations which finished at most this long ago instead of waiting for '
+                   'the next one (default: {}s)'.format(DEFAULT_STACK_EVENT_MAX_AGE))
+@click.pass_obj
+def wait_for_stack(config, stack_name, timeout, interval, max_age):
+    '''Wait for one or more Cloud Formation stacks to finish, printing new stack events'''
+    states = wait_for_stacks(config, stack_name, timeout=timeout, interval=min(2, interval), max_interval=interval,
+                             max_age=max_age)
+    if None in states.values():
+        pending = [name for name, state in states.items() if state is None]
+        error('Timeout waiting for stack(s) {}'.format(', '.join(pending)))
+        raise click.Abort()
+    if 'failed' in states.values():
+        exit(1)
 
 
 @cli.command('encrypt')
+@click.option('--batch', is_flag=True,
+              help='Encrypt KEY=VALUE or JSON lines and print them as YAML env block')
+@click.option('--concurrency', type=click.IntRange(1, 64, clamp=True), default=8,
+              help='Number of concurrent requests in batch mode (default: 8)')
 @click.pass_obj
-def encrypt(config):
+def encrypt(config, batch, concurrency):
     '''Encrypt plain text (read from stdin) for deployment configuration'''
-    plain_text = sys.stdin.read()
-    api_url = config.get('deploy_api')
-    url = '{}/secrets'.format(api_url)
-    response = request(config, requests.post, url, json={'plaintext': plain_text})
-    print("deployment-secret:{}".format(response.json()['data']))
+    if not batch:
+        plain_text = sys.stdin.read()
+        print(encrypt_secret(config, plain_text))
+        return
 
+    secrets = parse_batch_secrets(sys.stdin)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        encrypted = executor.map(lambda secret: encrypt_secret(config, secret[1]), secrets)
+        env = [{'name': key, 'value': val} for (key, _), val in zip(secrets, encrypted)]
+    if env:
+        print(yaml.safe_dump(env, default_flow_style=False), end='')
 
-def copy_template(template_path: Path, path: Path, variables: dict):
-    for d in template_path.iterdir():
-        target_path = path / d.relative_to(template_path)
-        if d.is_dir():
-            copy_template(d, target_path, variables)
-        elif target_path.exists():
+
+def load_template(template_path: Path):
+    '''Read all files of the given template folder, returns dict relative path -> contents'''
+    files = {}
+    for d in sorted(template_path.rglob('*')):
+        if d.is_file():
+            with d.open() as fd:
+                files[d.relative_to(template_path)] = fd.read()
+    return files
+
+
+def write_template(files: dict, path: Path, variables: dict, verbose: bool=True):
+    for relative_path in files:
+        target_path = path / relative_path
+        if target_path.exists():
             # better not overwrite any existing files!
             raise click.UsageError('Target file "{}" already exists. Aborting!'.format(target_path))
-        else:
-            with Action('Writing {}..'.format(target_path)):
-                target_path.parent.mkdir(parents=True, exist_ok=True)
-                with d.open() as fd:
-                    contents = fd.read()
-                template = string.Template(contents)
-                contents = template.safe_substitute(variables)
-                with target_path.open('w') as fd:
-                    fd.write(contents)
+    for relative_path, contents in sorted(files.items()):
+        target_path = path / relative_path
+        with Action('Writing {}..'.format(target_path)) if verbose else contextlib.suppress():
+            target_path.parent.mkdir(parents=True, exist_ok=True)
+            template = string.Template(contents)
+            with target_path.open('w') as fd:
+                fd.write(template.safe_substitute(variables))
+
+
+def copy_template(template_path: Path, path: Path, variables: dict):
+    write_template(load_template(template_path), path, variables)
 
 
-def read_senza_variables(fd):
+def read_senza_variables(fd, headroom: float=DEFAULT_SENZA_HEADROOM):
     variables = {}
     data = yaml.safe_load(fd)
 
@@ -678,9 +1866,10 @@ def read_senza_variables(fd):
                 taupage_config = definition.get('TaupageConfig')
                 if not taupage_config:
                     raise click.UsageError('Missing "TaupageConfig" property in Senza component "{}"'.format(name))
-                # just assume half the main memory of the EC2 instance type
-                variables['memory'] = '{}Mi'.format(round(
-                                      EC2_INSTANCE_MEMORY.get(taupage_config.get('InstanceType'), 1000) * 0.5))
+                instance_type = definition.get('InstanceType') or taupage_config.get('InstanceType')
+                if instance_type not in instance_types.EC2_INSTANCE_TYPES:
+                    warning('Unknown EC2 instance type "{}", assuming t2.micro resources'.format(instance_type))
+                variables.update(instance_types.get_resources(instance_type, headroom))
                 variables['image'] = taupage_config.get('source', '').replace('{{Arguments.ImageVersion}}',
                                                                               '{{ version }}')
                 variables['env'] = taupage_config.get('environment', {})
@@ -710,6 +1899,93 @@ def prepare_variables(variables: dict):
     return variables
 
 
+def get_cluster_variables(cluster_id: str):
+    parts = cluster_id.split(':')
+    return {'cluster_id': cluster_id, 'account_id': ':'.join(parts[:2]), 'region': parts[2]}
+
+
+def validate_cluster_id(ctx, param, value):
+    if value is not None and len(value.split(':')) != 4:
+        raise click.BadParameter('must be a Kubernetes cluster ID like "aws:123456789012:eu-central-1:kube-1"')
+    return value
+
+
+headroom_option = click.option('--headroom', type=click.FloatRange(0, 0.9), default=DEFAULT_SENZA_HEADROOM,
+                               help='Fraction of the EC2 instance CPU/memory to reserve when sizing containers '
+                                    '(default: {})'.format(DEFAULT_SENZA_HEADROOM))
+
+
+def find_senza_files(patterns):
+    '''Find Senza files by directory (all YAML files in it), glob pattern or file name'''
+    paths = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            paths.extend(sorted(glob.glob(os.path.join(pattern, '*.yaml'))))
+        else:
+            paths.extend(sorted(glob.glob(pattern)) or [pattern])
+    return list(dict.fromkeys(paths))
+
+
+_senza_template_files = None
+
+
+def get_senza_template_files():
+    '''Load Senza deploy folder template once per (worker) process'''
+    global _senza_template_files
+    if _senza_template_files is None:
+        _senza_template_files = load_template(Path(__file__).parent / 'templates' / 'senza')
+    return _senza_template_files
+
+
+def _migrate_senza_file(senza_path: str, output_path: str, cluster_variables: dict, headroom: float):
+    try:
+        with open(senza_path, 'r') as fd:
+            variables = read_senza_variables(fd, headroom)
+        variables.update(cluster_variables)
+        variables = prepare_variables(variables)
+        write_template(get_senza_template_files(), Path(output_path), variables, verbose=False)
+    except Exception as e:
+        message = e.format_message() if isinstance(e, click.ClickException) else str(e)
+        return senza_path, output_path, message or e.__class__.__name__
+    return senza_path, output_path, None
+
+
+@cli.command('migrate-senza')
+@click.argument('senza_files', nargs=-1, required=True)
+@click.option('--kubernetes-cluster', required=True, callback=validate_cluster_id,
+              help='Kubernetes cluster ID to use for all converted Senza definitions')
+@click.option('--output-directory', type=click.Path(file_okay=False), default='.',
+              help='Write one deploy folder per Senza file into this directory (default: current directory)')
+@click.option('-j', '--jobs', type=click.IntRange(1, 64, clamp=True),
+              help='Number of parallel processes (default: number of CPUs)')
+@headroom_option
+@click.pass_obj
+def migrate_senza(config, senza_files, kubernetes_cluster, output_directory, jobs, headroom):
+    '''Convert many Senza definitions to deploy folders (non-interactive)'''
+    paths = find_senza_files(senza_files)
+    cluster_variables = get_cluster_variables(kubernetes_cluster)
+
+    tasks = [(path, os.path.join(output_directory, Path(path).stem), cluster_variables, headroom)
+             for path in paths]
+    # e.g. a/app.yaml and b/app.yaml: parallel workers would overwrite each other's deploy folder
+    output_paths = collections.Counter(os.path.normpath(task[1]) for task in tasks)
+    duplicates = [task for task in tasks if output_paths[os.path.normpath(task[1])] > 1]
+    tasks = [task for task in tasks if task not in duplicates]
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(_migrate_senza_file, *task) for task in tasks]
+        results = [future.result() for future in futures]
+    results += [(path, output_path, 'Deploy folder is the same for several Senza files')
+                for path, output_path, _, _ in duplicates]
+
+    rows = [{'senza_file': senza_path, 'deploy_folder': output_path, 'status': message or 'OK'}
+            for senza_path, output_path, message in results]
+    print_rows('senza_file deploy_folder status'.split(), rows)
+    failed = sum(1 for row in rows if row['status'] != 'OK')
+    if failed:
+        error('{} of {} Senza definitions could not be converted.'.format(failed, len(rows)))
+        exit(1)
+
+
 @cli.command('init')
 @click.argument('directory', nargs=-1)
 @click.option('-t', '--template', help='Use a custom template (default: webapp)',
@@ -717,8 +1993,9 @@ def prepare_variables(variables: dict):
 @click.option('--from-senza', help='Convert Senza definition',
               type=click.File('r'), metavar='SENZA_FILE')
 @click.option('--kubernetes-cluster')
+@headroom_option
 @click.pass_obj
-def init(config, directory, template, from_senza, kubernetes_cluster):
+def init(config, directory, template, from_senza, kubernetes_cluster, headroom):
     '''Initialize a new deploy folder with Kubernetes manifests'''
     if directory:
         path = Path(directory[0])
@@ -726,7 +2003,7 @@ def init(config, directory, template, from_senza, kubernetes_cluster):
         path = Path('.')
 
     if from_senza:
-        variables = read_senza_variables(from_senza)
+        variables = read_senza_variables(from_senza, headroom)
         template = 'senza'
     else:
         variables = {}
@@ -740,10 +2017,7 @@ def init(config, directory, template, from_senza, kubernetes_cluster):
         while len(cluster_id.split(':')) != 4:
             cluster_id = click.prompt('Kubernetes Cluster ID to use')
 
-    variables['cluster_id'] = cluster_id
-    parts = cluster_id.split(':')
-    variables['account_id'] = ':'.join(parts[:2])
-    variables['region'] = parts[2]
+    variables.update(get_cluster_variables(cluster_id))
 
     template_path = Path(__file__).parent / 'templates' / template
     variables = prepare_variables(variables)
@@ -756,5 +2030,104 @@ def init(config, directory, template, from_senza, kubernetes_cluster):
         print(fd.read())
 
 
+@cli.command('refresh-completion-index')
+@click.pass_obj
+def refresh_completion_index(config):
+    '''Update local index of applications, versions, releases and change requests for shell completion'''
+    path = completion.get_completion_index_path()
+    try:
+        applications = {}
+        namespace = config.get('kubernetes_namespace')
+        kubectl_login(config)
+        for deployment in kubectl_get(namespace, 'deployments')['items']:
+            labels = deployment.get('spec', {}).get('template', {}).get('metadata', {}).get('labels', {})
+            if labels.get('application') and labels.get('version') and labels.get('release'):
+                releases = applications.setdefault(labels['application'], {}).setdefault(labels['version'], [])
+                releases.append(labels['release'])
+        response = request(config, requests.get, '/change-requests', exit_on_error=False)
+        change_requests = []
+        if 200 <= response.status_code < 400:
+            change_requests = [item['id'] for item in response.json()['items']]
+        index = {'updated': time.time(), 'applications': applications, 'change_requests': change_requests}
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + '.tmp', 'w') as fd:
+            json.dump(index, fd)
+        os.replace(path + '.tmp', path)
+    except BaseException:
+        # keep the lock (with the time of this attempt) to not retry on every completion, e.g. when offline
+        with contextlib.suppress(OSError):
+            os.utime(path + '.lock')
+        raise
+    else:
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(path + '.lock')
+
+
+@cli.command('stats')
+@click.option('--operation', type=click.Choice(['command', 'request', 'kubectl_get', 'kubectl_login',
+                                                'render_template']),
+              help='Only show the given operation')
+@click.option('--since', type=float, metavar='HOURS', help='Only include operations of the last hours')
+def stats(operation, since):
+    '''Show duration percentiles of recorded operations (see "configure --metrics")'''
+    samples = metrics.load_history(click.get_app_dir('zalando-deploy-cli'))
+    if operation:
+        samples = (sample for sample in samples if sample['operation'] == operation)
+    if since is not None:
+        cutoff = time.time() - since * 3600
+        samples = (sample for sample in samples if sample['time'] >= cutoff)
+    print_rows('operation labels count p50 p95 max'.split(), metrics.summarize(samples))
+
+
+def get_agent_socket_path(config: dict):
+    return config.get('agent_socket') or os.path.join(click.get_app_dir('zalando-deploy-cli'), 'agent.sock')
+
+
+@cli.command('agent')
+@click.option('--socket', 'socket_path', metavar='PATH', help='Unix socket to listen on')
+@click.pass_obj
+def run_agent(config, socket_path):
+    '''Run local agent to keep sessions warm across CLI calls'''
+    socket_path = socket_path or get_agent_socket_path(config)
+    server = agent.AgentServer(socket_path, lambda args: cli.main(args=args, prog_name='zdeploy'))
+    info('Agent listening on {}..'.format(socket_path))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def get_command_name(args: list):
+    '''Get full name of the (sub)command to be invoked by the given arguments, skipping global options'''
+    options_with_value = {opt for param in cli.params if isinstance(param, click.Option) and not param.is_flag
+                          for opt in param.opts + param.secondary_opts}
+    args = iter(args)
+    for arg in args:
+        if arg in options_with_value:
+            next(args, None)
+        elif not arg.startswith('-'):
+            command = cli.get_command(click.Context(cli), arg)
+            return command.name if command else arg
+    return None
+
+
+def is_forwardable(args: list):
+    '''Check whether the given CLI invocation can run inside the agent'''
+    command_name = get_command_name(args)
+    if not command_name or command_name in AGENT_LOCAL_COMMANDS:
+        return False
+    return not any(arg.split('=', 1)[0] in AGENT_LOCAL_OPTIONS for arg in args)
+
+
 def main():
+    args = sys.argv[1:]
+    if is_forwardable(args):
+        config = stups_cli.config.load_config('zalando-deploy-cli')
+        response = agent.forward(get_agent_socket_path(config), args)
+        if response is not None:
+            sys.stdout.write(response['stdout'])
+            sys.stderr.write(response['stderr'])
+            sys.exit(response['exit_code'])
     cli()
@@ -0,0 +1,174 @@
+'''
+Fast shell completion from a local index of applications, versions, releases and change requests
+
+Completing an argument must not wait for the network or for importing the whole CLI
+(requests, zign, pierone, ..). This module therefore only uses the standard library: the
+console script answers bash/zsh completion requests for the arguments below directly and
+falls back to click's regular completion for everything else.
+'''
+import json
+import os
+import shlex
+import subprocess
+import sys
+import time
+
+APP_NAME = 'zalando-deploy-cli'
+
+# shell completion uses a local index which is refreshed in the background after this time
+COMPLETION_INDEX_TTL = 300  # seconds
+
+COMPLETE_VAR = '_ZDEPLOY_COMPLETE'
+
+# global options taking a value (see "cli" group)
+GLOBAL_OPTIONS_WITH_VALUE = frozenset(['-o', '--output'])
+
+# positional arguments of commands (up to the last one completed from the index), "*" marks a variadic
+# argument and None any other argument (checked against the commands' shell_complete callbacks in the tests)
+APP_VERSION_RELEASE = ('application', 'version', 'release')
+COMMAND_ARGUMENTS = {
+    'apply-autoscaling': (None, ) + APP_VERSION_RELEASE,
+    'approve-change-request': ('change_request_id*', ),
+    'bundle': (None, ) + APP_VERSION_RELEASE,
+    'create-deployment': (None, ) + APP_VERSION_RELEASE,
+    'delete-old-deployments': APP_VERSION_RELEASE,
+    'execute-change-request': ('change_request_id*', ),
+    'get-change-request': ('change_request_id*', ),
+    'get-current-replicas': ('application', ),
+    'list-approvals': ('change_request_id', ),
+    'promote-deployment': APP_VERSION_RELEASE,
+    'resolve-version': (None, ) + APP_VERSION_RELEASE,
+    'scale-deployment': APP_VERSION_RELEASE,
+    'switch-deployment': APP_VERSION_RELEASE,
+    'wait-for-change-request': ('change_request_id*', ),
+    'wait-for-deployment': APP_VERSION_RELEASE,
+}
+
+
+def get_app_dir():
+    '''Same directory as click.get_app_dir() on POSIX systems (without importing click)'''
+    if sys.platform == 'darwin':
+        return os.path.join(os.path.expanduser('~/Library/Application Support'), APP_NAME)
+    return os.path.join(os.environ.get('XDG_CONFIG_HOME') or os.path.expanduser('~/.config'), APP_NAME)
+
+
+def get_completion_index_path():
+    return os.path.join(get_app_dir(), 'completion-index.json')
+
+
+def load_completion_index():
+    '''Load local completion index and trigger a background refresh if it is outdated'''
+    path = get_completion_index_path()
+    try:
+        with open(path) as fd:
+            index = json.load(fd)
+    except (OSError, ValueError):
+        index = {}
+    if time.time() - index.get('updated', 0) > COMPLETION_INDEX_TTL:
+        refresh_completion_index_in_background(path)
+    return index
+
+
+def refresh_completion_index_in_background(path: str):
+    lock_path = path + '.lock'
+    try:
+        if time.time() - os.stat(lock_path).st_mtime < COMPLETION_INDEX_TTL:
+            # refresh is already running or failed recently
+            return
+        os.unlink(lock_path)
+    except FileNotFoundError:
+        pass
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.close(os.open(lock_path, os.O_CREAT | os.O_EXCL))
+    except OSError:
+        return
+    # do not let the child process run in completion mode
+    env = {key: val for key, val in os.environ.items()
+           if not (key.startswith('_') and key.endswith('_COMPLETE')) and not key.startswith('COMP_')}
+    subprocess.Popen([sys.executable, '-m', 'zalando_deploy_cli', 'refresh-completion-index'], env=env,
+                     stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                     start_new_session=True)
+
+
+def get_completions(kind: str, values: dict, incomplete: str):
+    '''Get completions for argument kind ("application", ..) given the values of previous arguments'''
+    index = load_completion_index()
+    applications = index.get('applications', {})
+    if kind == 'application':
+        candidates = sorted(applications)
+    elif kind == 'version':
+        candidates = sorted(applications.get(values.get('application'), {}))
+    elif kind == 'release':
+        candidates = sorted(applications.get(values.get('application'), {}).get(values.get('version'), []))
+    else:
+        candidates = index.get('change_requests', [])
+    return [candidate for candidate in candidates if candidate.startswith(incomplete)]
+
+
+def get_argument_kind(args: list, incomplete: str):
+    '''Get (kind, values of previous arguments) of the argument being completed, None if not supported'''
+    if incomplete.startswith('-'):
+        return None
+    args = iter(args)
+    command = None
+    for arg in args:
+        if arg in GLOBAL_OPTIONS_WITH_VALUE:
+            next(args, None)
+        elif not arg.startswith('-'):
+            command = arg
+            break
+    kinds = COMMAND_ARGUMENTS.get(command)
+    if not kinds:
+        # unknown command, command aliases/prefixes or no command yet
+        return None
+    positional = list(args)
+    if any(arg.startswith('-') for arg in positional):
+        # command options might take values: let click parse them
+        return None
+    values = {}
+    for kind, arg in zip(kinds, positional):
+        if kind:
+            values[kind.rstrip('*')] = arg
+    if len(positional) < len(kinds):
+        kind = kinds[len(positional)]
+    elif kinds[-1].endswith('*'):
+        kind = kinds[-1]
+    else:
+        return None
+    if kind is None:
+        # e.g. file names
+        return None
+    return kind.rstrip('*'), values
+
+
+def complete(shell: str, comp_words: str, comp_cword: str):
+    '''Return completion output for the given shell or None to fall back to click'''
+    if shell not in ('bash_complete', 'zsh_complete'):
+        return None
+    try:
+        words = shlex.split(comp_words)
+        cword = int(comp_cword)
+    except ValueError:
+        return None
+    args = words[1:cword]
+    incomplete = words[cword] if cword < len(words) else ''
+    argument = get_argument_kind(args, incomplete)
+    if argument is None:
+        return None
+    completions = get_completions(argument[0], argument[1], incomplete)
+    if shell == 'bash_complete':
+        return ''.join('plain,{}\n'.format(value) for value in completions)
+    return ''.join('plain\n{}\n_\n'.format(value) for value in completions)
+
+
+def main():
+    '''Console script: answer completion requests directly if possible, otherwise run the CLI'''
+    shell = os.environ.get(COMPLETE_VAR)
+    if shell:
+        output = complete(shell, os.environ.get('COMP_WORDS', ''), os.environ.get('COMP_CWORD', ''))
+        if output is not None:
+            sys.stdout.write(output)
+            sys.exit(0)
+    from .cli import main as cli_main
+    cli_main()
@@ -0,0 +1,122 @@
+'''
+Catalogue of EC2 instance types to size Kubernetes pods when converting Senza definitions
+'''
+import collections
+
+InstanceType = collections.namedtuple('InstanceType', 'vcpu memory')
+
+# EC2 instance type -> (number of vCPUs, memory in MiB)
+EC2_INSTANCE_TYPES = {name: InstanceType(*resources) for name, resources in {
+    't1.micro': (1, 613),
+    't2.nano': (1, 512),
+    't2.micro': (1, 1024),
+    't2.small': (1, 2048),
+    't2.medium': (2, 4096),
+    't2.large': (2, 8192),
+    't2.xlarge': (4, 16384),
+    't2.2xlarge': (8, 32768),
+    't3.nano': (2, 512),
+    't3.micro': (2, 1024),
+    't3.small': (2, 2048),
+    't3.medium': (2, 4096),
+    't3.large': (2, 8192),
+    't3.xlarge': (4, 16384),
+    't3.2xlarge': (8, 32768),
+    'm1.small': (1, 1740),
+    'm1.medium': (1, 3840),
+    'm1.large': (2, 7680),
+    'm1.xlarge': (4, 15360),
+    'm3.medium': (1, 3840),
+    'm3.large': (2, 7680),
+    'm3.xlarge': (4, 15360),
+    'm3.2xlarge': (8, 30720),
+    'm4.large': (2, 8192),
+    'm4.xlarge': (4, 16384),
+    'm4.2xlarge': (8, 32768),
+    'm4.4xlarge': (16, 65536),
+    'm4.10xlarge': (40, 163840),
+    'm4.16xlarge': (64, 262144),
+    'm5.large': (2, 8192),
+    'm5.xlarge': (4, 16384),
+    'm5.2xlarge': (8, 32768),
+    'm5.4xlarge': (16, 65536),
+    'm5.12xlarge': (48, 196608),
+    'm5.24xlarge': (96, 393216),
+    'c3.large': (2, 3840),
+    'c3.xlarge': (4, 7680),
+    'c3.2xlarge': (8, 15360),
+    'c3.4xlarge': (16, 30720),
+    'c3.8xlarge': (32, 61440),
+    'c4.large': (2, 3840),
+    'c4.xlarge': (4, 7680),
+    'c4.2xlarge': (8, 15360),
+    'c4.4xlarge': (16, 30720),
+    'c4.8xlarge': (36, 61440),
+    'c5.large': (2, 4096),
+    'c5.xlarge': (4, 8192),
+    'c5.2xlarge': (8, 16384),
+    'c5.4xlarge': (16, 32768),
+    'c5.9xlarge': (36, 73728),
+    'c5.18xlarge': (72, 147456),
+    'r3.large': (2, 15616),
+    'r3.xlarge': (4, 31232),
+    'r3.2xlarge': (8, 62464),
+    'r3.4xlarge': (16, 124928),
+    'r3.8xlarge': (32, 249856),
+    'r4.large': (2, 15616),
+    'r4.xlarge': (4, 31232),
+    'r4.2xlarge': (8, 62464),
+    'r4.4xlarge': (16, 124928),
+    'r4.8xlarge': (32, 249856),
+    'r4.16xlarge': (64, 499712),
+    'r5.large': (2, 16384),
+    'r5.xlarge': (4, 32768),
+    'r5.2xlarge': (8, 65536),
+    'r5.4xlarge': (16, 131072),
+    'r5.12xlarge': (48, 393216),
+    'r5.24xlarge': (96, 786432),
+    'i2.xlarge': (4, 31232),
+    'i2.2xlarge': (8, 62464),
+    'i2.4xlarge': (16, 124928),
+    'i2.8xlarge': (32, 249856),
+    'i3.large': (2, 15616),
+    'i3.xlarge': (4, 31232),
+    'i3.2xlarge': (8, 62464),
+    'i3.4xlarge': (16, 124928),
+    'i3.8xlarge': (32, 249856),
+    'i3.16xlarge': (64, 499712),
+    'd2.xlarge': (4, 31232),
+    'd2.2xlarge': (8, 62464),
+    'd2.4xlarge': (16, 124928),
+    'd2.8xlarge': (36, 249856),
+    'x1.16xlarge': (64, 999424),
+    'x1.32xlarge': (128, 1998848),
+    'p2.xlarge': (4, 62464),
+    'p2.8xlarge': (32, 499712),
+    'p2.16xlarge': (64, 749568),
+    'g2.2xlarge': (8, 15360),
+    'g2.8xlarge': (32, 61440),
+    'g3.4xlarge': (16, 124928),
+    'g3.8xlarge': (32, 249856),
+    'g3.16xlarge': (64, 499712),
+}.items()}
+
+# used for unknown instance types (same as t2.micro)
+DEFAULT_INSTANCE_TYPE = EC2_INSTANCE_TYPES['t2.micro']
+
+
+def get_resources(instance_type: str, headroom: float):
+    '''Get Kubernetes container resources for an application previously running on the given EC2 instance type
+
+    The headroom is the fraction of the instance's CPU and memory not available to the application
+    (e.g. for the OS and other agents). Requests get the remaining share. The CPU limit allows bursting
+    up to the full instance, the memory limit equals the request to avoid overcommitting memory.'''
+    resources = EC2_INSTANCE_TYPES.get(instance_type, DEFAULT_INSTANCE_TYPE)
+    cpu_request = max(round(resources.vcpu * 1000 * (1 - headroom)), 10)
+    memory_request = max(round(resources.memory * (1 - headroom)), 16)
+    return {
+        'cpu_request': '{}m'.format(cpu_request),
+        'cpu_limit': '{}m'.format(resources.vcpu * 1000),
+        'memory_request': '{}Mi'.format(memory_request),
+        'memory_limit': '{}Mi'.format(memory_request)
+    }
@@ -0,0 +1,185 @@
+'''
+Opt-in collection of operation durations (deploy API requests, kubectl calls, template rendering, commands)
+
+Samples of every CLI run are appended to a local NDJSON history (rotated when it gets too large)
+and aggregated into cumulative histograms which can be exported as a Prometheus textfile
+for the node-exporter textfile collector.
+'''
+import contextlib
+import fcntl
+import functools
+import json
+import os
+import re
+import time
+
+from .utils import percentile
+
+HISTORY_FILE_NAME = 'metrics.ndjson'
+TOTALS_FILE_NAME = 'metrics-totals.json'
+
+# history is rotated (one old file is kept) when reaching this size
+MAX_HISTORY_SIZE = 4 * 1024 * 1024  # bytes
+
+# histogram buckets (upper bounds in seconds, +Inf is implicit)
+BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 1800)
+
+METRIC_NAME = 'zdeploy_operation_duration_seconds'
+
+# path segments which are most probably IDs (contain a digit) are replaced to keep the number of endpoints small
+ID_PATTERN = re.compile('.*[0-9]')
+
+_enabled = False
+_samples = []
+
+
+def enable():
+    global _enabled
+    _enabled = True
+
+
+def is_enabled():
+    return _enabled
+
+
+def get_endpoint(method_name: str, path: str):
+    '''Get endpoint label like "GET /change-requests/{id}" for the given request'''
+    segments = ['{id}' if ID_PATTERN.match(segment) else segment for segment in path.split('?')[0].split('/')]
+    return '{} {}'.format(method_name.upper(), '/'.join(segments))
+
+
+@contextlib.contextmanager
+def timer(operation: str, **labels):
+    '''Measure duration of the wrapped block (if enabled), labels can still be added inside the block'''
+    if not _enabled:
+        yield labels
+        return
+    start = time.time()
+    try:
+        yield labels
+    finally:
+        _samples.append({'time': round(start, 3), 'operation': operation,
+                         'labels': {key: str(val) for key, val in labels.items()},
+                         'seconds': round(time.time() - start, 6)})
+
+
+def timed(operation: str, get_labels=None):
+    '''Decorator measuring the duration of every function call, get_labels(*args) returns additional labels'''
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            labels = get_labels(*args) if _enabled and get_labels else {}
+            with timer(operation, **labels):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def get_series_key(operation: str, labels: dict):
+    return json.dumps(dict(labels, operation=operation), sort_keys=True)
+
+
+def add_to_totals(totals: dict, samples: list):
+    '''Add samples to cumulative histograms (dict of series key -> {"buckets", "sum", "count"})'''
+    for sample in samples:
+        series = totals.setdefault(get_series_key(sample['operation'], sample['labels']),
+                                   {'buckets': [0] * len(BUCKETS), 'sum': 0, 'count': 0})
+        for i, upper_bound in enumerate(BUCKETS):
+            if sample['seconds'] <= upper_bound:
+                series['buckets'][i] += 1
+        series['sum'] += sample['seconds']
+        series['count'] += 1
+    return totals
+
+
+def _escape(value: str):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_textfile(totals: dict):
+    '''Format cumulative histograms in the Prometheus text exposition format'''
+    lines = ['# HELP {} Duration of zdeploy operations.'.format(METRIC_NAME),
+             '# TYPE {} histogram'.format(METRIC_NAME)]
+    for key in sorted(totals):
+        series = totals[key]
+        labels = ','.join('{}="{}"'.format(name, _escape(val)) for name, val in sorted(json.loads(key).items()))
+        for upper_bound, count in zip(BUCKETS + ('+Inf', ), series['buckets'] + [series['count']]):
+            lines.append('{}_bucket{{{},le="{}"}} {}'.format(METRIC_NAME, labels, upper_bound, count))
+        lines.append('{}_sum{{{}}} {}'.format(METRIC_NAME, labels, round(series['sum'], 6)))
+        lines.append('{}_count{{{}}} {}'.format(METRIC_NAME, labels, series['count']))
+    return '\n'.join(lines) + '\n'
+
+
+def _write_atomically(path: str, contents: str):
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'w') as fd:
+        fd.write(contents)
+    os.replace(tmp_path, path)
+
+
+@contextlib.contextmanager
+def _locked(directory: str):
+    '''Serialize concurrent CLI processes updating the metrics files'''
+    with open(os.path.join(directory, 'metrics.lock'), 'w') as fd:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+
+
+def flush(directory: str, textfile_path: str=None):
+    '''Append collected samples to the history and update totals and Prometheus textfile (if given)'''
+    global _samples
+    samples, _samples = _samples, []
+    if not samples:
+        return
+    os.makedirs(directory, exist_ok=True)
+    history_path = os.path.join(directory, HISTORY_FILE_NAME)
+    totals_path = os.path.join(directory, TOTALS_FILE_NAME)
+    with _locked(directory):
+        with contextlib.suppress(FileNotFoundError):
+            if os.path.getsize(history_path) >= MAX_HISTORY_SIZE:
+                os.replace(history_path, history_path + '.1')
+        with open(history_path, 'a') as fd:
+            fd.write(''.join(json.dumps(sample, separators=(',', ':')) + '\n' for sample in samples))
+        try:
+            with open(totals_path) as fd:
+                totals = json.load(fd)
+        except (OSError, ValueError):
+            totals = {}
+        add_to_totals(totals, samples)
+        _write_atomically(totals_path, json.dumps(totals))
+        if textfile_path:
+            _write_atomically(textfile_path, format_textfile(totals))
+
+
+def load_history(directory: str):
+    '''Yield all samples of the (rotated and current) history'''
+    history_path = os.path.join(directory, HISTORY_FILE_NAME)
+    for path in (history_path + '.1', history_path):
+        with contextlib.suppress(FileNotFoundError), open(path) as fd:
+            for line in fd:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    # incomplete line of an interrupted write
+                    pass
+
+
+def summarize(samples):
+    '''Summarize durations per operation and labels (e.g. endpoint), slowest first'''
+    durations = {}
+    for sample in samples:
+        durations.setdefault(get_series_key(sample['operation'], sample['labels']), []).append(sample['seconds'])
+    rows = []
+    for key, values in durations.items():
+        labels = json.loads(key)
+        operation = labels.pop('operation')
+        rows.append({'operation': operation,
+                     'labels': ' '.join('{}={}'.format(*item) for item in sorted(labels.items())),
+                     'count': len(values),
+                     'p50': round(percentile(values, 50), 3),
+                     'p95': round(percentile(values, 95), 3),
+                     'max': round(max(values), 3)})
+    return sorted(rows, key=lambda row: row['p95'], reverse=True)
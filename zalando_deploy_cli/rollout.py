@@ -0,0 +1,64 @@
+'''
+Rollout latency report computed from Kubernetes pod conditions and container statuses
+
+All durations are seconds since the pod's creation (Kubernetes timestamps have second resolution).
+'''
+import datetime
+
+from .utils import percentile
+
+PHASES = ('scheduled', 'started', 'ready')
+
+
+def parse_timestamp(value: str):
+    if not value:
+        return None
+    return datetime.datetime.strptime(value, '%Y-%m-%dT%H:%M:%SZ')
+
+
+def _seconds_since(start, timestamp: str):
+    end = parse_timestamp(timestamp)
+    if start is None or end is None:
+        return None
+    return max((end - start).total_seconds(), 0)
+
+
+def get_pod_latencies(pod: dict):
+    '''Get time from creation to scheduled, (last) container start and ready for a single pod
+
+    Phases not reached (yet) are None.'''
+    created = parse_timestamp(pod['metadata'].get('creationTimestamp'))
+    status = pod.get('status', {})
+    conditions = {condition['type']: condition for condition in status.get('conditions', [])}
+    containers = {}
+    for container_status in status.get('containerStatuses', []):
+        running = container_status.get('state', {}).get('running', {})
+        containers[container_status['name']] = _seconds_since(created, running.get('startedAt'))
+    started = None
+    if containers and None not in containers.values():
+        started = max(containers.values())
+    latencies = {'pod': pod['metadata']['name'], 'containers': containers, 'started': started}
+    for phase, condition_type in ('scheduled', 'PodScheduled'), ('ready', 'Ready'):
+        condition = conditions.get(condition_type, {})
+        reached = condition.get('status') == 'True'
+        latencies[phase] = _seconds_since(created, condition.get('lastTransitionTime')) if reached else None
+    return latencies
+
+
+def get_report(pods: list, slowest: int=3):
+    '''Build rollout latency report with p50/p95/max per phase and the slowest pods and containers'''
+    latencies = [get_pod_latencies(pod) for pod in pods]
+    summary = []
+    for phase in PHASES:
+        values = [row[phase] for row in latencies if row[phase] is not None]
+        summary.append({'phase': phase, 'pods': len(values), 'p50': percentile(values, 50),
+                        'p95': percentile(values, 95), 'max': max(values) if values else None})
+    containers = [{'pod': row['pod'], 'container': name, 'started': started}
+                  for row in latencies for name, started in row['containers'].items() if started is not None]
+    return {
+        'pods': latencies,
+        'summary': summary,
+        'slowest_pods': sorted((row for row in latencies if row['ready'] is not None),
+                               key=lambda row: row['ready'], reverse=True)[:slowest],
+        'slowest_containers': sorted(containers, key=lambda row: row['started'], reverse=True)[:slowest]
+    }
@@ -0,0 +1,12 @@
+'''
+Helpers shared by the rollout report and the metrics summary
+'''
+import math
+
+
+def percentile(values: list, p: float):
+    '''Nearest-rank percentile of the given values (None for an empty list)'''
+    if not values:
+        return None
+    values = sorted(values)
+    return values[max(math.ceil(p / 100 * len(values)) - 1, 0)]
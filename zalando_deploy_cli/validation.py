@@ -0,0 +1,149 @@
+'''
+Local pre-flight validation of rendered Kubernetes manifests and Cloud Formation templates
+
+Schemas are bundled in schemas.yaml (a subset of JSON Schema), cached on disk as JSON
+and compiled into validation functions once per process.
+'''
+import hashlib
+import json
+import os
+import re
+from pathlib import Path
+
+import yaml
+
+SCHEMAS_PATH = Path(__file__).parent / 'schemas.yaml'
+
+TYPES = {
+    'object': dict,
+    'array': list,
+    'string': str,
+    'integer': int,
+    'number': (int, float),
+    'boolean': bool
+}
+
+_compiled_schemas = None
+
+
+def _is_type(value, type_name: str):
+    if isinstance(value, bool) and type_name in ('integer', 'number'):
+        return False
+    return isinstance(value, TYPES[type_name])
+
+
+def _type_name(value):
+    for name, type_ in TYPES.items():
+        if _is_type(value, name):
+            return name
+    return 'null' if value is None else type(value).__name__
+
+
+def _child_path(path: str, key):
+    if isinstance(key, int):
+        return '{}[{}]'.format(path, key)
+    return '{}.{}'.format(path, key) if path else str(key)
+
+
+def compile_schema(schema: dict):
+    '''Compile schema into a function validate(value, path, errors) appending error messages to errors'''
+    types = schema.get('type')
+    if isinstance(types, str):
+        types = [types]
+    required = schema.get('required', [])
+    properties = {key: compile_schema(val) for key, val in schema.get('properties', {}).items()}
+    additional = schema.get('additionalProperties')
+    if isinstance(additional, dict):
+        additional = compile_schema(additional)
+    items = compile_schema(schema['items']) if 'items' in schema else None
+    enum = schema.get('enum')
+    pattern = re.compile(schema['pattern']) if 'pattern' in schema else None
+    minimum = schema.get('minimum')
+    min_items = schema.get('minItems')
+    min_properties = schema.get('minProperties')
+
+    def validate(value, path, errors):
+        location = path or '<root>'
+        if types and not any(_is_type(value, type_name) for type_name in types):
+            errors.append('{}: expected {}, got {}'.format(location, ' or '.join(types), _type_name(value)))
+            return
+        if enum is not None and value not in enum:
+            errors.append('{}: must be one of {}'.format(location, ', '.join(map(str, enum))))
+        if pattern and isinstance(value, str) and not pattern.search(value):
+            errors.append('{}: "{}" does not match "{}"'.format(location, value, pattern.pattern))
+        if minimum is not None and _is_type(value, 'number') and value < minimum:
+            errors.append('{}: must be at least {}'.format(location, minimum))
+        if isinstance(value, list):
+            if min_items is not None and len(value) < min_items:
+                errors.append('{}: must have at least {} items'.format(location, min_items))
+            if items:
+                for i, item in enumerate(value):
+                    items(item, _child_path(path, i), errors)
+        if isinstance(value, dict):
+            for key in required:
+                if key not in value:
+                    errors.append('{}: missing required property "{}"'.format(location, key))
+            if min_properties is not None and len(value) < min_properties:
+                errors.append('{}: must have at least {} properties'.format(location, min_properties))
+            for key, val in value.items():
+                if key in properties:
+                    properties[key](val, _child_path(path, key), errors)
+                elif additional is False:
+                    errors.append('{}: unexpected property "{}"'.format(location, key))
+                elif callable(additional):
+                    additional(val, _child_path(path, key), errors)
+
+    return validate
+
+
+def load_schemas(cache_dir: str=None):
+    '''Load bundled schemas, using a JSON copy in cache_dir (if given) to avoid slow YAML parsing'''
+    contents = SCHEMAS_PATH.read_bytes()
+    cache_path = None
+    if cache_dir:
+        digest = hashlib.sha256(contents).hexdigest()[:16]
+        cache_path = os.path.join(cache_dir, 'schemas-{}.json'.format(digest))
+        try:
+            with open(cache_path) as fd:
+                return json.load(fd)
+        except (OSError, ValueError):
+            pass
+    schemas = yaml.safe_load(contents)
+    if cache_path:
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            with open(cache_path, 'w') as fd:
+                json.dump(schemas, fd)
+        except OSError:
+            # caching is optional
+            pass
+    return schemas
+
+
+def get_compiled_schemas(cache_dir: str=None):
+    global _compiled_schemas
+    if _compiled_schemas is None:
+        schemas = load_schemas(cache_dir)
+        _compiled_schemas = {
+            'kubernetes': {kind: compile_schema(schema) for kind, schema in schemas['kubernetes'].items()},
+            'cloudformation': compile_schema(schemas['cloudformation'])
+        }
+    return _compiled_schemas
+
+
+def validate_manifest(data, cache_dir: str=None):
+    '''Validate rendered Kubernetes manifest or Cloud Formation template, returns list of errors'''
+    schemas = get_compiled_schemas(cache_dir)
+    errors = []
+    if not isinstance(data, dict):
+        errors.append('Invalid YAML contents: expected object, got {}'.format(_type_name(data)))
+    elif 'kind' in data:
+        schemas['kubernetes']['_base'](data, '', errors)
+        validate_kind = schemas['kubernetes'].get(data['kind']) if isinstance(data['kind'], str) else None
+        if validate_kind:
+            validate_kind(data, '', errors)
+    elif 'Resources' in data:
+        schemas['cloudformation'](data, '', errors)
+    else:
+        errors.append('Neither a Kubernetes manifest nor a Cloud Formation template')
+    return errors